@@ -1,4 +1,4 @@
-import React, { useEffect, useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import { Link } from 'react-router-dom';
 import { useAuth } from '../context/AuthContext';
 import {
@@ -17,25 +17,38 @@ interface Order {
   status: 'waiting' | 'received' | 'cancelled';
   sms_code: string | null;
   timestamp: string;
+  change_seq?: number;
 }
 
+const PAGE_SIZE = 50;
+
+const mergeOrders = (prev: Order[], changed: Order[]) => {
+  const ids = new Set(changed.map(o => o.id));
+  return [...changed, ...prev.filter(o => !ids.has(o.id))]
+    .sort((a, b) => b.timestamp.localeCompare(a.timestamp) || b.id - a.id);
+};
+
 const Dashboard: React.FC = () => {
   const { user, token, quota, refreshQuota } = useAuth();
   const [orders, setOrders] = useState<Order[]>([]);
   const [isLoading, setIsLoading] = useState(true);
   const [isRefreshing, setIsRefreshing] = useState(false);
 
+  const [nextBefore, setNextBefore] = useState<string | null>(null);
+  const seqRef = useRef<number | null>(null);
+
+  const authHeaders = { 'Authorization': `Bearer ${token}` };
+
+  // First page of history plus the change sequence to sync from
   const fetchOrders = async () => {
     if (!token) return;
     try {
-      const response = await fetch('/api/orders', {
-        headers: {
-          'Authorization': `Bearer ${token}`
-        }
-      });
+      const response = await fetch(`/api/orders?limit=${PAGE_SIZE}`, { headers: authHeaders });
       if (response.ok) {
         const data = await response.json();
-        setOrders(data);
+        setOrders(data.orders);
+        setNextBefore(data.next_before);
+        seqRef.current = data.seq;
       }
     } catch (error) {
       console.error('Failed to fetch orders', error);
@@ -44,6 +57,39 @@ const Dashboard: React.FC = () => {
     }
   };
 
+  // Only the orders that changed since the last sync
+  const syncOrders = async () => {
+    if (!token) return;
+    if (seqRef.current === null) return fetchOrders();
+    try {
+      let more = true;
+      while (more) {
+        const response = await fetch(`/api/orders?since=${seqRef.current}`, { headers: authHeaders });
+        if (!response.ok) return;
+        const data = await response.json();
+        if (data.orders.length) setOrders(prev => mergeOrders(prev, data.orders));
+        seqRef.current = data.seq;
+        more = data.more;
+      }
+    } catch (error) {
+      console.error('Failed to sync orders', error);
+    }
+  };
+
+  const loadOlderOrders = async () => {
+    if (!token || !nextBefore) return;
+    try {
+      const response = await fetch(`/api/orders?limit=${PAGE_SIZE}&before=${encodeURIComponent(nextBefore)}`, { headers: authHeaders });
+      if (response.ok) {
+        const data = await response.json();
+        setOrders(prev => mergeOrders(prev, data.orders));
+        setNextBefore(data.next_before);
+      }
+    } catch (error) {
+      console.error('Failed to load older orders', error);
+    }
+  };
+
   const checkStatus = async (orderId: string) => {
     if (!token) return;
     try {
@@ -53,7 +99,7 @@ const Dashboard: React.FC = () => {
         }
       });
       if (response.ok) {
-        fetchOrders();
+        syncOrders();
         refreshQuota();
       }
     } catch (error) {
@@ -67,7 +113,7 @@ const Dashboard: React.FC = () => {
       headers: { Authorization: `Bearer ${token}` }
     });
     if (res.ok) {
-      fetchOrders(); // refresh orders list
+      syncOrders(); // refresh orders list
     }
   };
 
@@ -81,7 +127,7 @@ const Dashboard: React.FC = () => {
       body: JSON.stringify({ service_id: serviceId, country_id: countryId })
     });
     if (res.ok) {
-      fetchOrders();
+      syncOrders();
     }
   };
 
@@ -93,15 +139,86 @@ const Dashboard: React.FC = () => {
   };
 
   useEffect(() => {
+    seqRef.current = null;
     fetchOrders();
   }, [token]);
 
+  // Live updates over SSE; fall back to polling if the stream can't be held open
   useEffect(() => {
-    const interval = setInterval(() => {
-        fetchOrders();
+    if (!token) return;
+    let interval: any;
+    const startPolling = () => {
+      if (interval) return;
+      interval = setInterval(() => {
+        syncOrders();
         refreshQuota();
-    }, 10000);
-    return () => clearInterval(interval);
+      }, 10000);
+    };
+
+    if (typeof EventSource === 'undefined') {
+      startPolling();
+      return () => clearInterval(interval);
+    }
+
+    let source: EventSource | null = null;
+    let reconnect: any;
+    let closed = false;
+    let failures = 0;
+    let lastEventId = '';
+
+    // Each connection gets a fresh single-use ticket, so the session token never goes in a URL
+    const connect = async () => {
+      let ticket: string;
+      try {
+        const response = await fetch('/api/orders/stream-ticket', { method: 'POST', headers: authHeaders });
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        ticket = (await response.json()).ticket;
+      } catch (error) {
+        console.error('Failed to open order stream', error);
+        startPolling();
+        return;
+      }
+      if (closed) return;
+
+      const params = new URLSearchParams({ ticket });
+      if (lastEventId) params.set('last_event_id', lastEventId);
+      const current = new EventSource(`/api/orders/stream?${params}`);
+      source = current;
+      const track = (e: Event) => {
+        lastEventId = (e as MessageEvent).lastEventId || lastEventId;
+      };
+      current.onopen = () => { failures = 0; };
+      current.addEventListener('ready', track);
+      current.addEventListener('order', (e) => {
+        track(e);
+        const changed: Order = JSON.parse((e as MessageEvent).data);
+        setOrders(prev => mergeOrders(prev, [changed]));
+        refreshQuota();
+      });
+      current.addEventListener('resync', (e) => {
+        track(e);
+        syncOrders();
+        refreshQuota();
+      });
+      current.onerror = () => {
+        // The browser would retry with the ticket it already used; reconnect with a new one
+        current.close();
+        if (closed) return;
+        if (++failures > 3) {
+          startPolling();
+          return;
+        }
+        reconnect = setTimeout(connect, 3000);
+      };
+    };
+    connect();
+
+    return () => {
+      closed = true;
+      source?.close();
+      clearTimeout(reconnect);
+      clearInterval(interval);
+    };
   }, [token]);
 
   if (!user) {
@@ -296,6 +413,17 @@ const Dashboard: React.FC = () => {
             {historyOrders.map(order => <OrderCard key={order.id} order={order} />)}
           </div>
         )}
+
+        {!isLoading && nextBefore && (
+          <div className="mt-8 text-center">
+            <button
+              onClick={loadOlderOrders}
+              className="px-6 py-2 bg-zinc-900 border border-zinc-800 rounded-full text-sm text-zinc-300 hover:text-white hover:border-emerald-500/50 transition-all"
+            >
+              Load older orders
+            </button>
+          </div>
+        )}
       </div>
 
       <div className="mt-12 p-8 glass-panel rounded-[2rem] border border-emerald-500/10 bg-emerald-500/5">
@@ -46,27 +46,54 @@ const DirectPurchase = () => {
     };
 
     useEffect(() => {
+        if (status !== 'waiting' || !orderData?.order_id) return;
         let interval: any;
-        if (status === 'waiting' && orderData?.order_id) {
-            interval = setInterval(async () => {
-                try {
-                    const res = await fetch(`/api/direct/status?token=${token}&order_id=${orderData.order_id}`);
-                    const data = await res.json();
-                    if (data.status === 'received') {
-                        setSmsCode(data.sms_code);
-                        setStatus('received');
-                        clearInterval(interval);
-                    } else if (data.status === 'cancelled') {
-                        setError('Order was cancelled');
-                        setStatus('error');
-                        clearInterval(interval);
-                    }
-                } catch (err) {
-                    console.error("Status check failed", err);
-                }
-            }, 5000);
+
+        const applyUpdate = (data: any) => {
+            if (data.status === 'received') {
+                setSmsCode(data.sms_code);
+                setStatus('received');
+            } else if (data.status === 'cancelled') {
+                setError('Order was cancelled');
+                setStatus('error');
+            }
+        };
+
+        const checkStatus = async () => {
+            try {
+                const res = await fetch(`/api/direct/status?token=${token}&order_id=${orderData.order_id}`);
+                applyUpdate(await res.json());
+            } catch (err) {
+                console.error("Status check failed", err);
+            }
+        };
+
+        const startPolling = () => {
+            if (interval) return;
+            interval = setInterval(checkStatus, 5000);
+        };
+
+        if (typeof EventSource === 'undefined') {
+            startPolling();
+            return () => clearInterval(interval);
         }
-        return () => clearInterval(interval);
+
+        const source = new EventSource(`/api/direct/stream?token=${encodeURIComponent(token || '')}`);
+        source.addEventListener('order', (e) => {
+            const data = JSON.parse((e as MessageEvent).data);
+            if (String(data.order_id_provider) === String(orderData.order_id)) applyUpdate(data);
+        });
+        // Catch anything that changed before the stream was (re)opened
+        source.addEventListener('ready', checkStatus);
+        source.addEventListener('resync', checkStatus);
+        source.onerror = () => {
+            if (source.readyState === EventSource.CLOSED) startPolling();
+        };
+
+        return () => {
+            source.close();
+            clearInterval(interval);
+        };
     }, [status, orderData, token]);
 
     if (!token) {
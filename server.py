@@ -2,14 +2,31 @@ import os
 import sys
 import sqlite3
 import jwt
+import json
+import hmac
+import hashlib
 import datetime
 import threading
+import time
+import random
+import secrets
+import queue
+import cProfile
+import contextvars
 import requests
-from flask import Flask, send_from_directory, request, jsonify, make_response
+from collections import deque, OrderedDict
+from types import MappingProxyType
+from requests.adapters import HTTPAdapter
+from flask import Flask, send_from_directory, request, jsonify, make_response, Response, g
 from flask_cors import CORS
+from flask.json.provider import DefaultJSONProvider
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
 from functools import wraps
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 import telebot
 
 # Load environment variables
@@ -46,6 +63,12 @@ if __name__ == '__main__':
 app = Flask(__name__, static_folder='dist' if os.path.exists('dist') else '.')
 CORS(app)
 
+# Behind a reverse proxy request.remote_addr is the proxy itself. TRUSTED_PROXY_HOPS is how many
+# proxies sit in front of the app; their X-Forwarded-For entries are then trusted for the client IP.
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', '0'))
+if TRUSTED_PROXY_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS, x_host=TRUSTED_PROXY_HOPS)
+
 SECRET_KEY = os.environ.get('SECRET_KEY')
 if not SECRET_KEY:
     if os.environ.get('FLASK_ENV') == 'production':
@@ -55,16 +78,232 @@ if not SECRET_KEY:
 HERO_SMS_API_KEY = os.environ.get('HERO_SMS_API_KEY', '')
 TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '')
 ADMIN_TELEGRAM_ID = os.environ.get('ADMIN_TELEGRAM_ID', '')
+# The background jobs (price refresher, status poller, warm inventory, stale order sweeper,
+# orphaned activation cancels) run in one process only. Like BOT_LEADER, `python server.py` leads; under gunicorn and
+# friends set BACKGROUND_LEADER=1 (or just BOT_LEADER=1) on exactly one worker.
+BACKGROUND_LEADER = os.environ.get('BACKGROUND_LEADER', os.environ.get('BOT_LEADER', '1' if __name__ == '__main__' else '0')) == '1'
+
+# --- Metrics ---
+# Prometheus metrics at /metrics (Bearer METRICS_TOKEN if set). Values are per process,
+# so with several workers scrape each one. Subsystems define their own metrics next to
+# the code they measure.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+HTTP_LATENCY = Histogram('http_request_duration_seconds', 'Time to produce a response, by route', ['method', 'route'])
+HTTP_REQUESTS = Counter('http_requests_total', 'Responses by route and status code', ['method', 'route', 'status'])
+DB_QUERY_SECONDS = Histogram('db_query_seconds', 'SQLite execute/executemany time',
+                             buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1, 5))
+
+# --- Request timing ---
+# Time spent in SQLite, HeroSMS calls and JSON encoding is added up per request and sent
+# back as a Server-Timing header (visible in the browser's network panel; calls made in
+# parallel, as in /api/generate-numbers, are summed so may exceed the total). With
+# PROFILE_SLOW_MS set, PROFILE_SAMPLE_RATE of requests also run under cProfile and the
+# ones slower than the threshold are written to PROFILE_DIR (open with `python -m pstats`).
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', '0'))
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0.1'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+
+# {'db': s, 'provider': s, 'json': s} for the request being handled in this context
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+# Only one request is profiled at a time, which also bounds the profiling overhead
+_profile_lock = threading.Lock()
+
+def add_request_timing(kind, seconds):
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[kind] += seconds
+
+class TimedJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            add_request_timing('json', time.perf_counter() - started)
+
+app.json = TimedJSONProvider(app)
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+    _request_timings.set({'db': 0.0, 'provider': 0.0, 'json': 0.0})
+    if PROFILE_SLOW_MS > 0 and random.random() < PROFILE_SAMPLE_RATE and _profile_lock.acquire(blocking=False):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def _record_request_metrics(response):
+    started = g.get('request_started')
+    # The rule, not the path, so order ids don't explode the label set
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        HTTP_LATENCY.labels(request.method, route).observe(elapsed)
+        timings = _request_timings.get() or {}
+        response.headers['Server-Timing'] = ', '.join(
+            [f'{kind};dur={seconds * 1000:.1f}' for kind, seconds in timings.items()] + [f'total;dur={elapsed * 1000:.1f}'])
+    HTTP_REQUESTS.labels(request.method, route, str(response.status_code)).inc()
+    return response
+
+@app.teardown_request
+def _finish_request_profile(exc):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return
+    try:
+        profiler.disable()
+        elapsed_ms = (time.perf_counter() - g.request_started) * 1000
+        if elapsed_ms >= PROFILE_SLOW_MS:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            route = (request.url_rule.rule if request.url_rule else 'unmatched').strip('/')
+            name = f"{int(time.time() * 1000)}-{request.method}-{route.replace('/', '_') or 'root'}-{elapsed_ms:.0f}ms.prof"
+            profiler.dump_stats(os.path.join(PROFILE_DIR, name.replace('<', '').replace('>', '').replace(':', '_')))
+    except Exception as e:
+        print(f"Could not save request profile: {e}")
+    finally:
+        _profile_lock.release()
+
+@app.route('/metrics')
+def metrics():
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+        return jsonify({'message': 'Unauthorized'}), 401
+    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
 
 
 # Database setup
 DB_PATH = 'smskenya.db'
+DB_BUSY_TIMEOUT = 5.0
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '16'))
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+class TimedCursor(sqlite3.Cursor):
+    """Times each statement including fetching its rows, which is where SQLite does most of
+    a SELECT's work. A statement is observed once when its rows are all fetched, or when the
+    cursor is reused, closed or dropped."""
+
+    _elapsed = None
+
+    def _timed(self, method, *args):
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            add_request_timing('db', elapsed)
+            self._elapsed = (self._elapsed or 0.0) + elapsed
+
+    def _observe(self):
+        if self._elapsed is not None:
+            DB_QUERY_SECONDS.observe(self._elapsed)
+            self._elapsed = None
+
+    def execute(self, *args):
+        self._observe()
+        return self._timed(super().execute, *args)
+
+    def executemany(self, *args):
+        self._observe()
+        return self._timed(super().executemany, *args)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed(super().fetchmany, *args)
+
+    def fetchall(self):
+        try:
+            return self._timed(super().fetchall)
+        finally:
+            self._observe()
+
+    def __next__(self):
+        try:
+            return self._timed(super().__next__)
+        except StopIteration:
+            self._observe()
+            raise
+
+    def close(self):
+        self._observe()
+        super().close()
+
+    def __del__(self):
+        self._observe()
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection whose close() rolls back and hands it back to the pool."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection.execute doesn't go through cursor(), so route it there for timing
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            add_request_timing('db', time.perf_counter() - started)
+
+    def close(self):
+        if getattr(self, '_in_pool', False):
+            return
+        try:
+            if self.in_transaction:
+                self.rollback()
+            self._in_pool = True
+            _db_pool.put_nowait(self)
+        except (queue.Full, sqlite3.Error):
+            sqlite3.Connection.close(self)
+
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+def _open_connection():
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT, check_same_thread=False,
+                           cached_statements=256, factory=PooledConnection)
     conn.row_factory = sqlite3.Row
+    # WAL lets readers run alongside the writer; NORMAL is durable enough under WAL
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}')
+    conn._path = DB_PATH
     return conn
 
+def get_db_connection():
+    """Borrow a connection from the pool (opening one if it's empty). close() returns it."""
+    try:
+        conn = _db_pool.get_nowait()
+        if conn._path != DB_PATH:
+            sqlite3.Connection.close(conn)
+            conn = _open_connection()
+    except queue.Empty:
+        conn = _open_connection()
+    conn._in_pool = False
+    return conn
+
+@contextmanager
+def db():
+    """with db() as conn: ... commits on success, rolls back on error, then returns the connection."""
+    conn = get_db_connection()
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+def bump_mappings_version(conn):
+    """Tell every worker process that the mappings table changed."""
+    conn.execute('''
+        INSERT INTO settings (key, value) VALUES ('mappings_version', '1')
+        ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+    ''')
+
 def init_db():
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -148,6 +387,19 @@ def init_db():
     )
     ''')
 
+    # Escalator statistics: which price tier last worked per provider service/country
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS tier_stats (
+        p_service TEXT NOT NULL,
+        p_country TEXT NOT NULL,
+        success_tier REAL NOT NULL,
+        attempts INTEGER DEFAULT 1,
+        price_seen REAL,
+        last_seen REAL NOT NULL, -- unix time
+        PRIMARY KEY (p_service, p_country)
+    )
+    ''')
+
     # Seed initial settings
     cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('whitelist_required', '0')")
 
@@ -245,17 +497,199 @@ def init_db():
     cursor.execute("UPDATE mappings SET provider_id='86'  WHERE frontend_id='IT' AND type='country'")
     cursor.execute("UPDATE mappings SET provider_id='173' WHERE frontend_id='CH' AND type='country'")
     cursor.execute("DELETE FROM mappings WHERE frontend_id='KR' AND type='country'")
+    bump_mappings_version(cursor)
 
     # Patch existing quotas that might have the old default of 600
     cursor.execute("UPDATE quotas SET allowed_numbers = 0 WHERE allowed_numbers = 600")
 
     conn.commit()
+    migrate_db(conn)
     conn.close()
 
+# Versioned schema changes, applied once each in order on startup and recorded as
+# settings.schema_version. Append new steps at the end; never edit one that has shipped.
+SCHEMA_MIGRATIONS = [
+    (1, 'orders lookup indexes', [
+        # /api/orders, the SSE streams and the bot's active-orders view
+        'CREATE INDEX IF NOT EXISTS idx_orders_user_ts ON orders (user_id, timestamp DESC)',
+        # status updates, cancels, regen and the webhook
+        'CREATE INDEX IF NOT EXISTS idx_orders_provider ON orders (order_id_provider)',
+        # direct purchase status/cancel/stream
+        'CREATE INDEX IF NOT EXISTS idx_orders_token ON orders (token, order_id_provider)',
+        # status poller: only the handful of open orders, not the whole history
+        "CREATE INDEX IF NOT EXISTS idx_orders_waiting ON orders (order_id_provider) WHERE status = 'waiting'",
+    ]),
+    (2, 'orders change sequence and keyset index', [
+        # Every insert/update stamps the row with the next settings.orders_change_seq, so
+        # clients can ask for "what changed since N". Writers are serialized by SQLite,
+        # so a committed seq is never overtaken by a lower one committing later.
+        'ALTER TABLE orders ADD COLUMN change_seq INTEGER',
+        'UPDATE orders SET change_seq = id',
+        '''INSERT OR IGNORE INTO settings (key, value)
+           SELECT 'orders_change_seq', CAST(COALESCE(MAX(id), 0) AS TEXT) FROM orders''',
+        '''CREATE TRIGGER IF NOT EXISTS orders_seq_insert AFTER INSERT ON orders BEGIN
+               UPDATE settings SET value = CAST(value AS INTEGER) + 1 WHERE key = 'orders_change_seq';
+               UPDATE orders SET change_seq = (SELECT CAST(value AS INTEGER) FROM settings WHERE key = 'orders_change_seq')
+                WHERE id = NEW.id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS orders_seq_update
+           AFTER UPDATE OF user_id, service_id, country_id, phone_number, order_id_provider, status, sms_code, timestamp, token
+           ON orders BEGIN
+               UPDATE settings SET value = CAST(value AS INTEGER) + 1 WHERE key = 'orders_change_seq';
+               UPDATE orders SET change_seq = (SELECT CAST(value AS INTEGER) FROM settings WHERE key = 'orders_change_seq')
+                WHERE id = NEW.id;
+           END''',
+        'CREATE INDEX IF NOT EXISTS idx_orders_user_seq ON orders (user_id, change_seq)',
+        # Keyset pages order by (timestamp, id); the v1 index only covered timestamp
+        'DROP INDEX IF EXISTS idx_orders_user_ts',
+        'CREATE INDEX IF NOT EXISTS idx_orders_user_keyset ON orders (user_id, timestamp DESC, id DESC)',
+    ]),
+    (3, 'users token_version for session revocation', [
+        'ALTER TABLE users ADD COLUMN token_version INTEGER DEFAULT 0',
+    ]),
+    (4, 'warm number inventory', [
+        '''CREATE TABLE IF NOT EXISTS warm_numbers (
+               order_id_provider TEXT PRIMARY KEY,
+               service_id TEXT NOT NULL,
+               country_id TEXT NOT NULL,
+               phone_number TEXT NOT NULL,
+               cost REAL,
+               acquired_at REAL NOT NULL -- unix time
+           )''',
+        'CREATE INDEX IF NOT EXISTS idx_warm_pair ON warm_numbers (service_id, country_id, acquired_at)',
+        'CREATE INDEX IF NOT EXISTS idx_warm_age ON warm_numbers (acquired_at)',
+    ]),
+    (5, 'case-insensitive username index for /find', [
+        # The UNIQUE autoindex uses BINARY collation, which LIKE (case-insensitive) can't range-scan
+        'CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users (username COLLATE NOCASE)',
+    ]),
+    (6, 'single-use SSE stream tickets', [
+        # Shared by all workers: the ticket may be issued by one process and redeemed by another
+        '''CREATE TABLE IF NOT EXISTS stream_tickets (
+               ticket TEXT PRIMARY KEY,
+               user_id INTEGER NOT NULL,
+               token_version INTEGER NOT NULL DEFAULT 0,
+               expires_at REAL NOT NULL -- unix time
+           )''',
+        'CREATE INDEX IF NOT EXISTS idx_stream_tickets_expiry ON stream_tickets (expires_at)',
+    ]),
+    (7, 'orphaned activations awaiting a provider cancel', [
+        '''CREATE TABLE IF NOT EXISTS orphaned_activations (
+               order_id_provider TEXT PRIMARY KEY,
+               reason TEXT,
+               abandoned_at REAL NOT NULL -- unix time
+           )''',
+        'CREATE INDEX IF NOT EXISTS idx_orphaned_age ON orphaned_activations (abandoned_at)',
+    ]),
+]
+
+def get_schema_version(conn):
+    row = conn.execute("SELECT value FROM settings WHERE key = 'schema_version'").fetchone()
+    return int(row['value']) if row else 0
+
+def migrate_db(conn):
+    """Apply pending SCHEMA_MIGRATIONS. Each step runs in its own write transaction, so
+    concurrent worker processes starting together apply it exactly once."""
+    for version, description, statements in SCHEMA_MIGRATIONS:
+        if get_schema_version(conn) >= version:
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Another process may have applied it while we waited for the lock
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            for sql in statements:
+                conn.execute(sql)
+            conn.execute('''
+                INSERT INTO settings (key, value) VALUES ('schema_version', ?)
+                ON CONFLICT(key) DO UPDATE SET value = excluded.value
+            ''', (str(version),))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Applied schema migration {version}: {description}")
+
 init_db()
 
 # --- JWT Decorator ---
-def token_required(f):
+# Signed claims are trusted for identity; the users row is only needed to check the
+# token_version claim ('tv') against users.token_version. Rows are kept in a small LRU
+# keyed by (user id, token version). Revoking sessions bumps users.token_version and
+# settings.users_version, and every worker drops its cache within USER_VERSION_CHECK_INTERVAL.
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '4096'))
+USER_VERSION_CHECK_INTERVAL = 5
+
+_user_cache = OrderedDict()  # (user_id, token_version) -> user dict
+_user_cache_version = None
+_user_cache_checked_at = 0.0
+_user_cache_lock = threading.Lock()
+
+def bump_users_version(conn):
+    conn.execute('''
+        INSERT INTO settings (key, value) VALUES ('users_version', '1')
+        ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+    ''')
+
+def _check_user_cache_version():
+    global _user_cache_version, _user_cache_checked_at
+    if time.monotonic() - _user_cache_checked_at < USER_VERSION_CHECK_INTERVAL:
+        return
+    with _user_cache_lock:
+        if time.monotonic() - _user_cache_checked_at < USER_VERSION_CHECK_INTERVAL:
+            return
+        with db() as conn:
+            row = conn.execute("SELECT value FROM settings WHERE key = 'users_version'").fetchone()
+        version = row['value'] if row else None
+        if version != _user_cache_version:
+            _user_cache.clear()
+            _user_cache_version = version
+        _user_cache_checked_at = time.monotonic()
+
+def get_cached_user(user_id, token_version=0, fresh=False):
+    """User row as a dict, or None if the user is gone or the token version was revoked."""
+    key = (user_id, token_version)
+    if not fresh:
+        _check_user_cache_version()
+        with _user_cache_lock:
+            user = _user_cache.get(key)
+            if user is not None:
+                _user_cache.move_to_end(key)
+                return user
+
+    with db() as conn:
+        row = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+    if not row or (row['token_version'] or 0) != token_version:
+        return None
+    user = dict(row)
+    with _user_cache_lock:
+        _user_cache[key] = user
+        _user_cache.move_to_end(key)
+        while len(_user_cache) > USER_CACHE_SIZE:
+            _user_cache.popitem(last=False)
+    return user
+
+def revoke_user_sessions(user_id):
+    """Invalidate every token issued to user_id so far."""
+    with db() as conn:
+        conn.execute('UPDATE users SET token_version = COALESCE(token_version, 0) + 1 WHERE id = ?', (user_id,))
+        bump_users_version(conn)
+    with _user_cache_lock:
+        for key in [k for k in _user_cache if k[0] == int(user_id)]:
+            del _user_cache[key]
+
+def user_from_token(token, fresh=False):
+    """Decode a JWT and return its user (None if the user no longer exists or was logged out)."""
+    data = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
+    return get_cached_user(data['user_id'], data.get('tv', 0), fresh=fresh)
+
+def token_required(f=None, *, fresh=False):
+    """@token_required for reads; @token_required(fresh=True) re-checks the users row
+    for endpoints that spend quota or money."""
+    if f is None:
+        return lambda func: token_required(func, fresh=fresh)
+
     @wraps(f)
     def decorated(*args, **kwargs):
         token = None
@@ -266,10 +700,7 @@ def token_required(f):
             return jsonify({'message': 'Token is missing!'}), 401
 
         try:
-            data = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-            conn = get_db_connection()
-            current_user = conn.execute('SELECT * FROM users WHERE id = ?', (data['user_id'],)).fetchone()
-            conn.close()
+            current_user = user_from_token(token, fresh=fresh)
             if not current_user:
                  return jsonify({'message': 'User not found!'}), 401
         except Exception as e:
@@ -292,18 +723,15 @@ def register():
 
     hashed_password = generate_password_hash(password)
 
-    conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)', (username, hashed_password))
-        user_id = cursor.lastrowid
-        # Initialize quota
-        cursor.execute('INSERT INTO quotas (user_id, allowed_numbers, used_numbers) VALUES (?, ?, ?)', (user_id, 0, 0))
-        conn.commit()
+        with db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)', (username, hashed_password))
+            user_id = cursor.lastrowid
+            # Initialize quota
+            cursor.execute('INSERT INTO quotas (user_id, allowed_numbers, used_numbers) VALUES (?, ?, ?)', (user_id, 0, 0))
     except sqlite3.IntegrityError:
         return jsonify({'message': 'Username already exists!'}), 400
-    finally:
-        conn.close()
 
     # Notify admin on Telegram
     if TELEGRAM_BOT_TOKEN and ADMIN_TELEGRAM_ID:
@@ -323,9 +751,8 @@ def login():
     if not username or not password:
         return jsonify({'message': 'Username and password are required!'}), 400
 
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-    conn.close()
+    with db() as conn:
+        user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
 
     if not user or not check_password_hash(user['password_hash'], password):
         return jsonify({'message': 'Invalid username or password!'}), 401
@@ -333,6 +760,7 @@ def login():
     token = jwt.encode({
         'user_id': user['id'],
         'username': user['username'],
+        'tv': user['token_version'] or 0,
         'exp': datetime.datetime.now(datetime.UTC) + datetime.timedelta(hours=24)
     }, SECRET_KEY)
 
@@ -347,17 +775,14 @@ def login():
 @app.route('/api/me', methods=['GET'])
 @token_required
 def get_me(current_user):
-    conn = get_db_connection()
-    quota = conn.execute('SELECT * FROM quotas WHERE user_id = ?', (current_user['id'],)).fetchone()
-    if quota is None:
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO quotas (user_id, allowed_numbers, used_numbers) VALUES (?, 0, 0)',
-            (current_user['id'],)
-        )
-        conn.commit()
+    with db() as conn:
         quota = conn.execute('SELECT * FROM quotas WHERE user_id = ?', (current_user['id'],)).fetchone()
-    conn.close()
+        if quota is None:
+            conn.execute(
+                'INSERT INTO quotas (user_id, allowed_numbers, used_numbers) VALUES (?, 0, 0)',
+                (current_user['id'],)
+            )
+            quota = conn.execute('SELECT * FROM quotas WHERE user_id = ?', (current_user['id'],)).fetchone()
 
     return jsonify({
         'id': current_user['id'],
@@ -381,14 +806,11 @@ def get_services(current_user):
             {"id": "go", "name": "Google"}
         ])
 
-    res = call_hero_api('getServicesList')
-    if isinstance(res, dict):
-        services = [
-            {"id": k, "name": v.get("en", k)}
-            for k, v in res.items()
-        ]
-        return jsonify(services)
-    return jsonify({'error': 'Could not fetch services', 'details': str(res)}), 500
+    try:
+        entry = services_cache.get()
+    except ProviderError as e:
+        return jsonify({'error': 'Could not fetch services', 'details': str(e)}), 500
+    return cached_json_response(entry)
 
 @app.route('/api/countries', methods=['GET'])
 @token_required
@@ -402,66 +824,771 @@ def get_countries(current_user):
             {"id": "36", "name": "Canada"}
         ])
 
-    res = call_hero_api('getCountries')
-    if isinstance(res, list):
-        countries = [
-            {"id": str(c.get("id")), "name": c.get("eng", str(c.get("id")))}
-            for c in res
-        ]
-        return jsonify(countries)
-    return jsonify({'error': 'Could not fetch countries', 'details': str(res)}), 500
+    try:
+        entry = countries_cache.get()
+    except ProviderError as e:
+        return jsonify({'error': 'Could not fetch countries', 'details': str(e)}), 500
+    return cached_json_response(entry)
 
 # --- Hero-SMS API Integration (Mocked/Generic SMS-Activate protocol) ---
 
-BASE_API_URL = "https://hero-sms.com/stubs/handler_api.php"
+# Point at verification/fake_herosms.py to exercise the real request path without spend
+BASE_API_URL = os.environ.get('BASE_API_URL', 'https://hero-sms.com/stubs/handler_api.php')
+
+# (connect, read) timeouts in seconds; getNumberV2 can take a while on the provider side
+HERO_TIMEOUTS = {
+    'getNumberV2': (3.05, 25),
+    'getPrices': (3.05, 20),
+    'getServicesList': (3.05, 20),
+    'getCountries': (3.05, 20),
+}
+HERO_DEFAULT_TIMEOUT = (3.05, 10)
+
+# Read-only actions that are safe to repeat after a network error or 5xx
+HERO_IDEMPOTENT_ACTIONS = {
+    'getStatusV2', 'getPrices', 'getBalance',
+    'getServicesList', 'getCountries', 'getActiveActivations'
+}
+HERO_PURCHASE_ACTIONS = {'getNumber', 'getNumberV2'}
+# What HeroClient.call returns for a 204, so callers can tell it from an empty error body
+HERO_NO_CONTENT = 'NO_CONTENT'
+
+PROVIDER_LATENCY = Histogram('herosms_request_seconds', 'HeroSMS handler API request latency, per attempt', ['action'])
+PROVIDER_FAILURES = Counter('herosms_failures_total', 'HeroSMS calls without a usable response', ['action', 'reason'])
+
+
+class HeroClient:
+    """Pooled HTTP client for the HeroSMS handler API with retries and a circuit breaker.
+
+    The breaker has two scopes: 'all' (bad key, repeated 5xx/network failures) blocks
+    every action, while 'purchase' (NO_BALANCE) only blocks buying new numbers so
+    status checks and cancellations keep working.
+    """
+
+    def __init__(self, base_url, api_key, max_retries=2, backoff=0.3,
+                 failure_threshold=5, failure_cooldown=30, fatal_cooldown=300, pool_size=32):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.failure_threshold = failure_threshold
+        self.failure_cooldown = failure_cooldown
+        self.fatal_cooldown = fatal_cooldown
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = {'all': 0.0, 'purchase': 0.0}
+        self._open_reason = {'all': None, 'purchase': None}
+
+    def _error(self, action, message):
+        return {"error": message} if action.endswith('V2') else f"ERROR: {message}"
+
+    def _check_breaker(self, action):
+        now = time.monotonic()
+        with self._lock:
+            scopes = ['all', 'purchase'] if action in HERO_PURCHASE_ACTIONS else ['all']
+            for scope in scopes:
+                if now < self._open_until[scope]:
+                    return self._open_reason[scope]
+        return None
+
+    def _trip(self, scope, reason, cooldown):
+        with self._lock:
+            self._open_until[scope] = time.monotonic() + cooldown
+            self._open_reason[scope] = reason
+        print(f"HeroSMS circuit open ({scope}) for {cooldown}s: {reason}")
+
+    def _record(self, action, result, server_error):
+        if isinstance(result, dict):
+            code = result.get('status') or result.get('title') or ''
+        else:
+            code = result if isinstance(result, str) else ''
+        code = str(code).strip().upper()
+        if code in ('BAD_KEY', 'NO_KEY'):
+            self._trip('all', code, self.fatal_cooldown)
+        elif code == 'NO_BALANCE':
+            self._trip('purchase', code, self.failure_cooldown)
+
+        with self._lock:
+            if server_error:
+                self._failures += 1
+                tripped = self._failures >= self.failure_threshold
+                if tripped:
+                    self._failures = 0
+            else:
+                self._failures = 0
+                tripped = False
+        if tripped:
+            self._trip('all', 'provider unavailable', self.failure_cooldown)
+
+    def call(self, action, **kwargs):
+        reason = self._check_breaker(action)
+        if reason:
+            PROVIDER_FAILURES.labels(action, 'circuit_open').inc()
+            return self._error(action, f"circuit open: {reason}")
+
+        params = {'api_key': self.api_key, 'action': action}
+        params.update(kwargs)
+        timeout = HERO_TIMEOUTS.get(action, HERO_DEFAULT_TIMEOUT)
+        attempts = 1 + (self.max_retries if action in HERO_IDEMPOTENT_ACTIONS else 0)
+
+        for attempt in range(attempts):
+            if attempt:
+                # Exponential backoff with full jitter
+                time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+            started = time.perf_counter()
+            try:
+                response = self.session.get(self.base_url, params=params, timeout=timeout)
+            except requests.RequestException as e:
+                result, server_error = self._error(action, str(e)), True
+                PROVIDER_FAILURES.labels(action, 'network').inc()
+            else:
+                # Try to parse as JSON first, fallback to text
+                if response.status_code == 204:
+                    result = HERO_NO_CONTENT
+                else:
+                    try:
+                        result = response.json()
+                    except ValueError:
+                        result = response.text
+                server_error = response.status_code >= 500
+                if server_error:
+                    PROVIDER_FAILURES.labels(action, 'server_error').inc()
+            PROVIDER_LATENCY.labels(action).observe(time.perf_counter() - started)
+            if not server_error:
+                break
+            self._record(action, result, server_error)
+        else:
+            return result
+
+        self._record(action, result, server_error)
+        return result
+
+
+hero_client = HeroClient(BASE_API_URL, HERO_SMS_API_KEY)
 
 def call_hero_api(action, **kwargs):
-    params = {
-        'api_key': HERO_SMS_API_KEY,
-        'action': action
-    }
-    params.update(kwargs)
+    started = time.perf_counter()
     try:
-        response = requests.get(BASE_API_URL, params=params)
-        # Try to parse as JSON first, fallback to text
+        return hero_client.call(action, **kwargs)
+    finally:
+        # Whole call including retry backoff, for the request's Server-Timing
+        add_request_timing('provider', time.perf_counter() - started)
+
+def cancel_accepted(res):
+    """cancelActivation succeeded: a 204, or ACCESS_CANCEL from the legacy protocol. An empty
+    body with any other status (e.g. a proxy's 503) is not a success."""
+    return res in (HERO_NO_CONTENT, 'ACCESS_CANCEL') or (isinstance(res, dict) and res.get('status') == 'SUCCESS')
+
+class ProviderError(Exception):
+    """The provider returned something other than the expected payload."""
+
+
+class SWRCache:
+    """Caches the result of `loader()` for `ttl` seconds.
+
+    Within `max_stale` seconds after expiry the stale value is served while one background
+    thread refreshes it; past that (or on a cold cache) callers block on a single shared load.
+    If a load fails the last good value keeps being served.
+    """
+
+    def __init__(self, name, loader, ttl, max_stale):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._value = None
+        self._fetched_at = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._refreshing = False
+
+    def _load(self):
+        value = self.loader()
+        with self._lock:
+            self._value = value
+            self._fetched_at = time.monotonic()
+        return value
+
+    def _refresh_in_background(self):
         try:
-            return response.json()
-        except:
-            return response.text
-    except Exception as e:
-        return {"error": str(e)} if action.endswith('V2') else f"ERROR: {str(e)}"
+            with self._load_lock:
+                self._load()
+        except Exception as e:
+            print(f"{self.name} refresh failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def refresh(self):
+        """Reload now, sharing the load with any concurrent callers."""
+        with self._load_lock:
+            return self._load()
+
+    def age(self):
+        with self._lock:
+            return None if self._fetched_at is None else time.monotonic() - self._fetched_at
+
+    def peek(self):
+        """Like get(), but never waits on a load: a cold or too stale cache returns None,
+        and any refresh it needs happens on a background thread."""
+        with self._lock:
+            value, fetched_at = self._value, self._fetched_at
+            age = None if fetched_at is None else time.monotonic() - fetched_at
+            if age is not None and age < self.ttl:
+                return value
+            if not self._refreshing:
+                self._refreshing = True
+                threading.Thread(target=self._refresh_in_background, daemon=True).start()
+        if age is not None and age < self.ttl + self.max_stale:
+            return value
+        return None
+
+    def get(self):
+        with self._lock:
+            value, fetched_at = self._value, self._fetched_at
+            age = None if fetched_at is None else time.monotonic() - fetched_at
+            if age is not None and age < self.ttl:
+                return value
+            if age is not None and age < self.ttl + self.max_stale:
+                if not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(target=self._refresh_in_background, daemon=True).start()
+                return value
+
+        with self._load_lock:
+            # Another caller may have finished the load while we waited
+            with self._lock:
+                if self._fetched_at is not None and self._fetched_at != fetched_at:
+                    return self._value
+            try:
+                return self._load()
+            except Exception:
+                if value is not None:
+                    return value
+                raise
+
+
+def _json_entry(data):
+    body = json.dumps(data, separators=(',', ':')).encode()
+    return {'data': data, 'body': body, 'etag': hashlib.sha1(body).hexdigest()}
+
+def cached_json_response(entry):
+    """Serve a cached JSON entry with an ETag, answering 304 when the client already has it."""
+    if entry['etag'] in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        response = make_response(entry['body'])
+        response.headers['Content-Type'] = 'application/json'
+    response.set_etag(entry['etag'])
+    # Always revalidate; the ETag makes that a cheap 304
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def _load_services():
+    res = call_hero_api('getServicesList')
+    if not isinstance(res, dict):
+        raise ProviderError(str(res))
+    return _json_entry([
+        {"id": k, "name": v.get("en", k)}
+        for k, v in res.items()
+    ])
+
+def _load_countries():
+    res = call_hero_api('getCountries')
+    if not isinstance(res, list):
+        raise ProviderError(str(res))
+    return _json_entry([
+        {"id": str(c.get("id")), "name": c.get("eng", str(c.get("id")))}
+        for c in res
+    ])
+
+CATALOG_TTL = int(os.environ.get('CATALOG_TTL', '3600'))
+CATALOG_MAX_STALE = 24 * 3600
+
+services_cache = SWRCache('services', _load_services, CATALOG_TTL, CATALOG_MAX_STALE)
+countries_cache = SWRCache('countries', _load_countries, CATALOG_TTL, CATALOG_MAX_STALE)
+
+# --- Mapping cache ---
+# The mappings table is held as an immutable snapshot that is swapped as a whole.
+# Writers bump settings.mappings_version so other worker processes reload it.
+
+MAPPING_VERSION_CHECK_INTERVAL = 5
+
+_mappings = (None, MappingProxyType({}))  # (version, {(type, frontend_id): provider_id})
+_mappings_checked_at = 0.0
+_mappings_lock = threading.Lock()
+
+def _read_mappings_version(conn):
+    row = conn.execute("SELECT value FROM settings WHERE key = 'mappings_version'").fetchone()
+    return row['value'] if row else None
+
+def load_mappings():
+    global _mappings, _mappings_checked_at
+    with db() as conn:
+        version = _read_mappings_version(conn)
+        rows = conn.execute('SELECT frontend_id, provider_id, type FROM mappings').fetchall()
+    snapshot = MappingProxyType({(r['type'], r['frontend_id']): r['provider_id'] for r in rows})
+    _mappings = (version, snapshot)
+    _mappings_checked_at = time.monotonic()
+    return snapshot
+
+def get_mappings():
+    """Current mapping snapshot; re-checks the version in settings at most every few seconds."""
+    global _mappings_checked_at
+    if time.monotonic() - _mappings_checked_at >= MAPPING_VERSION_CHECK_INTERVAL:
+        with _mappings_lock:
+            if time.monotonic() - _mappings_checked_at >= MAPPING_VERSION_CHECK_INTERVAL:
+                with db() as conn:
+                    version = _read_mappings_version(conn)
+                if version != _mappings[0]:
+                    load_mappings()
+                else:
+                    _mappings_checked_at = time.monotonic()
+    return _mappings[1]
 
 def get_mapping(frontend_id, mapping_type):
-    conn = get_db_connection()
-    row = conn.execute('SELECT provider_id FROM mappings WHERE frontend_id = ? AND type = ?', (frontend_id, mapping_type)).fetchone()
-    conn.close()
-    return row['provider_id'] if row else frontend_id
+    return get_mappings().get((mapping_type, frontend_id), frontend_id)
 
 def set_mapping(frontend_id, provider_id, mapping_type):
-    conn = get_db_connection()
-    conn.execute('INSERT OR REPLACE INTO mappings (frontend_id, provider_id, type) VALUES (?, ?, ?)',
-                 (frontend_id, provider_id, mapping_type))
-    conn.commit()
-    conn.close()
+    with db() as conn:
+        conn.execute('INSERT OR REPLACE INTO mappings (frontend_id, provider_id, type) VALUES (?, ?, ?)',
+                     (frontend_id, provider_id, mapping_type))
+        bump_mappings_version(conn)
+    with _mappings_lock:
+        load_mappings()
+
+load_mappings()
+
+PRICE_TIERS = [0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 15.0]
+
+PURCHASE_TIER = Histogram('purchase_escalator_tier_dollars', 'Highest maxPrice tier tried per purchase',
+                          ['outcome'], buckets=PRICE_TIERS)
+# One getPrices matrix ({country: {service: {cost, count}}}) shared by /api/prices,
+# the bot and the escalator, refreshed in the background every PRICE_REFRESH_INTERVAL.
+PRICE_REFRESH_INTERVAL = int(os.environ.get('PRICE_REFRESH_INTERVAL', '60'))
+
+def _load_price_matrix():
+    res = call_hero_api('getPrices')
+    if not isinstance(res, dict):
+        raise ProviderError(str(res))
+    return res
+
+price_matrix_cache = SWRCache('prices', _load_price_matrix, PRICE_REFRESH_INTERVAL * 2, 600)
+
+def get_price_matrix():
+    """Return the shared price matrix, or None if the provider has never answered."""
+    try:
+        return price_matrix_cache.get()
+    except ProviderError:
+        return None
+
+def _extract_price(res, p_service, p_country):
+    """Pull {cost, count} for one pair out of a getPrices response."""
+    if not isinstance(res, dict):
+        return None
+    info = res.get(str(p_country), {})
+    info = info.get(p_service) if isinstance(info, dict) else None
+    if not isinstance(info, dict) or info.get('cost') is None:
+        return None
+    try:
+        return {'cost': float(info['cost']), 'count': int(info.get('count', 0))}
+    except (TypeError, ValueError):
+        return None
+
+def get_cached_price(p_service, p_country):
+    """Return the provider's current {cost, count} for a pair from the shared price matrix,
+    or None if no usable snapshot is loaded yet. Never blocks a purchase on getPrices."""
+    return _extract_price(price_matrix_cache.peek(), p_service, p_country)
+
+def run_price_refresher():
+    while True:
+        try:
+            price_matrix_cache.refresh()
+        except Exception as e:
+            print(f"Price refresh failed: {e}")
+        time.sleep(PRICE_REFRESH_INTERVAL)
+
+if HERO_SMS_API_KEY and BACKGROUND_LEADER and PRICE_REFRESH_INTERVAL > 0:
+    price_refresher_thread = threading.Thread(target=run_price_refresher)
+    price_refresher_thread.daemon = True
+    price_refresher_thread.start()
+
+def _tier_index_for(cost):
+    """Index of the cheapest tier that covers `cost` (the top tier if none does)."""
+    for i, tier in enumerate(PRICE_TIERS):
+        if tier >= cost:
+            return i
+    return len(PRICE_TIERS) - 1
+
+TIER_DECAY_SECONDS = int(os.environ.get('TIER_DECAY_SECONDS', '1800'))
+
+def get_learned_tier(p_service, p_country):
+    """Return (tier_index, price_seen) for the last successful tier, stepping one tier
+    cheaper for every TIER_DECAY_SECONDS since it was recorded."""
+    with db() as conn:
+        row = conn.execute('SELECT success_tier, price_seen, last_seen FROM tier_stats WHERE p_service = ? AND p_country = ?',
+                           (p_service, str(p_country))).fetchone()
+    if not row:
+        return None
+    decay = int((time.time() - row['last_seen']) / TIER_DECAY_SECONDS) if TIER_DECAY_SECONDS > 0 else 0
+    idx = max(0, _tier_index_for(row['success_tier']) - decay)
+    return idx, row['price_seen']
+
+def record_tier_success(p_service, p_country, tier, attempts, price_seen):
+    with db() as conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO tier_stats (p_service, p_country, success_tier, attempts, price_seen, last_seen)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (p_service, str(p_country), tier, attempts, price_seen, time.time()))
 
 def get_number_with_smart_pricing(p_service, p_country):
-    """Try price tiers from cheapest to most expensive. Return first success."""
-    price_tiers = [0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 15.0]
+    """Buy at the cheapest tier covering the current provider price, escalating only if that fails.
+
+    If a higher tier recently succeeded for this pair we start there instead, unless the
+    provider price has dropped since then.
+    """
+    start = 0
+    price = get_cached_price(p_service, p_country)
+    if price and price['count'] > 0:
+        start = _tier_index_for(price['cost'])
+
+    learned = get_learned_tier(p_service, p_country)
+    if learned:
+        learned_idx, price_seen = learned
+        if not price or price_seen is None or price['cost'] >= price_seen:
+            start = max(start, learned_idx)
+
     last_res = None
-    for max_p in price_tiers:
-        res = call_hero_api('getNumberV2', service=p_service, country=p_country, maxPrice=max_p)
+    last_tier = None
+    attempts = 0
+    i = start
+    while i < len(PRICE_TIERS):
+        attempts += 1
+        res = call_hero_api('getNumberV2', service=p_service, country=p_country, maxPrice=PRICE_TIERS[i])
         if isinstance(res, dict) and 'activationId' in res:
+            record_tier_success(p_service, p_country, PRICE_TIERS[i], attempts, price['cost'] if price else None)
+            PURCHASE_TIER.labels('bought').observe(PRICE_TIERS[i])
             return res
         last_res = res
+        last_tier = PRICE_TIERS[i]
+        i += 1
+        # WRONG_MAX_PRICE:<min> tells us the floor directly, jump to it
+        if isinstance(res, str) and res.upper().startswith('WRONG_MAX_PRICE:'):
+            try:
+                i = max(i, _tier_index_for(float(res.split(':', 1)[1])))
+                continue
+            except ValueError:
+                break
         # Stop escalating if error is not "no numbers at this price"
         if isinstance(res, str) and 'NO_NUMBER' not in res.upper():
             break
         if isinstance(res, dict) and res.get('status') not in (None, 'NO_NUMBERS'):
             break
+    if last_tier is not None:
+        PURCHASE_TIER.labels('failed').observe(last_tier)
     return last_res
 
+# Replies meaning the provider has no such activation (any more); polling it again won't change that
+HERO_UNKNOWN_ACTIVATION = {'NO_ACTIVATION', 'WRONG_ACTIVATION_ID', 'NOT_FOUND'}
+
+def parse_status_v2(res):
+    """Map a getStatusV2 response to our (status, sms_code)."""
+    if isinstance(res, dict) and res.get('sms') and res['sms'].get('code'):
+        return 'received', res['sms']['code']
+    if res == "STATUS_CANCEL" or (isinstance(res, dict) and res.get('title') == 'CANCELED'):
+        return 'cancelled', None
+    title = res.get('title') if isinstance(res, dict) else res
+    if isinstance(title, str) and title in HERO_UNKNOWN_ACTIVATION:
+        return 'cancelled', None
+    return 'waiting', None
+
+# --- Order change events ---
+# In-process broadcast of order changes for the SSE streams. Every write to `orders`
+# calls notify_order_changed() so subscribers see it without polling.
+
+class OrderEvents:
+    def __init__(self, maxlen=1000):
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._log = deque(maxlen=maxlen)
+
+    def publish(self, order):
+        with self._cond:
+            self._seq += 1
+            self._log.append((self._seq, order))
+            self._cond.notify_all()
+
+    def since(self, seq):
+        """Return events after `seq`, or None if some of them were already dropped from the log."""
+        with self._cond:
+            if seq > self._seq or (self._log and self._log[0][0] > seq + 1):
+                return None
+            return [(s, o) for s, o in self._log if s > seq]
+
+    def wait(self, seq, timeout):
+        """Block until an event newer than `seq` is published or `timeout` passes. Returns the latest seq."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq > seq, timeout)
+            return self._seq
+
+    @property
+    def seq(self):
+        with self._cond:
+            return self._seq
+
+
+order_events = OrderEvents()
+
+def notify_order_changed(*order_ids):
+    if not order_ids:
+        return
+    with db() as conn:
+        rows = conn.execute(
+            f'SELECT * FROM orders WHERE order_id_provider IN ({",".join("?" * len(order_ids))})',
+            [str(o) for o in order_ids]
+        ).fetchall()
+    for row in rows:
+        order_events.publish(dict(row))
+
+STATUS_MAX_WAIT = 30
+
+def _requested_wait():
+    """Seconds a status request asked to long-poll for (?wait=), capped at STATUS_MAX_WAIT."""
+    try:
+        return min(max(float(request.args.get('wait', 0)), 0), STATUS_MAX_WAIT)
+    except ValueError:
+        return 0
+
+ORDER_WAIT_RECHECK = 1
+
+def wait_for_order_update(order_id, timeout, seq, still_waiting=None):
+    """Block until an event for `order_id` newer than `seq` is published. Returns True if one was.
+
+    Events are per process, so `still_waiting()` is also checked every ORDER_WAIT_RECHECK
+    seconds to catch updates written by the poller or webhook in another worker.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        events = order_events.since(seq)
+        if events is None:
+            return True
+        for event_seq, order in events:
+            if str(order['order_id_provider']) == str(order_id):
+                return True
+            seq = event_seq
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        order_events.wait(seq, min(remaining, ORDER_WAIT_RECHECK) if still_waiting else remaining)
+        if still_waiting and not still_waiting():
+            return True
+
+# --- Background status poller ---
+# One worker reconciles every waiting order from a single getActiveActivations call,
+# falling back to getStatusV2 for orders that are no longer in the active list. Those
+# per-order checks are capped per cycle and back off while the answer stays 'waiting'.
+
+STATUS_POLL_INTERVAL = float(os.environ.get('STATUS_POLL_INTERVAL', '5'))
+ACTIVE_ACTIVATIONS_PAGE = 100
+STATUS_CHECKS_PER_CYCLE = 20
+STATUS_CHECK_MAX_BACKOFF = 300
+
+_status_poller_last_sync = 0.0
+# order_id -> (monotonic time of its next getStatusV2, current backoff in seconds)
+_status_next_check = {}
+
+def _count_waiting_orders():
+    with db() as conn:
+        return conn.execute("SELECT COUNT(*) FROM orders WHERE status = 'waiting'").fetchone()[0]
+
+Gauge('orders_waiting', 'Orders waiting for an SMS').set_function(_count_waiting_orders)
+
+# Workers that don't run the poller read the leader's last sync time from settings
+STATUS_SYNC_CHECK_INTERVAL = 1
+_leader_status_synced_at = 0.0
+_leader_status_checked_at = float('-inf')
+
+def _leader_status_sync():
+    global _leader_status_synced_at, _leader_status_checked_at
+    if time.monotonic() - _leader_status_checked_at >= STATUS_SYNC_CHECK_INTERVAL:
+        with db() as conn:
+            row = conn.execute("SELECT value FROM settings WHERE key = 'status_poller_synced_at'").fetchone()
+        _leader_status_synced_at = float(row['value']) if row else 0.0
+        _leader_status_checked_at = time.monotonic()
+    return _leader_status_synced_at
+
+def status_poller_is_fresh():
+    """True if the poller completed a sync recently enough for endpoints to trust the DB."""
+    if STATUS_POLL_INTERVAL <= 0:
+        return False
+    if BACKGROUND_LEADER:
+        return time.monotonic() - _status_poller_last_sync < STATUS_POLL_INTERVAL * 3
+    return time.time() - _leader_status_sync() < STATUS_POLL_INTERVAL * 3
+
+def order_rows_are_current(waiting_for=0):
+    """True if a waiting order's row can be trusted without asking getStatusV2.
+
+    That holds while the poller keeps up. With only the webhook it holds for the first
+    PROVIDER_WEBHOOK_GRACE seconds: pushes never report expiries and one can be lost after
+    the provider's retries, so older orders are checked with the provider directly.
+    """
+    if not HERO_SMS_API_KEY:
+        return False
+    if status_poller_is_fresh():
+        return True
+    return bool(PROVIDER_WEBHOOK_SECRET) and waiting_for < PROVIDER_WEBHOOK_GRACE
+
+def _waiting_seconds(order):
+    try:
+        placed = datetime.datetime.strptime(order['timestamp'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=datetime.UTC)
+    except (TypeError, ValueError):
+        return float('inf')
+    return (datetime.datetime.now(datetime.UTC) - placed).total_seconds()
+
+def fetch_active_activations():
+    """Return {activationId: activation} for all active activations, or None on error."""
+    active = {}
+    start = 0
+    while True:
+        res = call_hero_api('getActiveActivations', start=start, limit=ACTIVE_ACTIVATIONS_PAGE)
+        if isinstance(res, dict) and res.get('error') == 'NO_ACTIVATIONS':
+            return active
+        if not isinstance(res, dict) or not isinstance(res.get('activeActivations'), list):
+            return None
+        batch = res['activeActivations']
+        for activation in batch:
+            active[str(activation.get('activationId'))] = activation
+        if len(batch) < ACTIVE_ACTIVATIONS_PAGE:
+            return active
+        start += ACTIVE_ACTIVATIONS_PAGE
+
+def sync_waiting_orders():
+    """Reconcile all waiting orders with the provider. Returns the number of orders updated."""
+    global _status_poller_last_sync
+
+    with db() as conn:
+        waiting = {row['order_id_provider']: row['user_id'] for row in
+                   conn.execute("SELECT order_id_provider, user_id FROM orders WHERE status = 'waiting'").fetchall()}
+    for order_id in list(_status_next_check):
+        if order_id not in waiting:
+            del _status_next_check[order_id]
+
+    active = fetch_active_activations() if waiting else {}
+    updates = []
+    # If the batch call failed, leave the DB stale for a cycle rather than ask about every order
+    if active is not None:
+        now = time.monotonic()
+        checks = 0
+        for order_id in waiting:
+            activation = active.get(order_id)
+            if activation is not None:
+                _status_next_check.pop(order_id, None)
+                if activation.get('smsCode'):
+                    updates.append(('received', str(activation['smsCode']), order_id))
+                continue
+            # Finished, cancelled or expired: ask for this one directly, when it's due
+            next_at, backoff = _status_next_check.get(order_id, (0.0, max(STATUS_POLL_INTERVAL, 1)))
+            if now < next_at or checks >= STATUS_CHECKS_PER_CYCLE:
+                continue
+            checks += 1
+            status, sms_code = parse_status_v2(call_hero_api('getStatusV2', id=order_id))
+            if status == 'waiting':
+                backoff = min(backoff * 2, STATUS_CHECK_MAX_BACKOFF)
+                _status_next_check[order_id] = (now + backoff, backoff)
+            else:
+                _status_next_check.pop(order_id, None)
+                updates.append((status, sms_code, order_id))
+
+    if updates:
+        with db() as conn:
+            for status, sms_code, order_id in updates:
+                apply_provider_status(conn, order_id, status, sms_code)
+        notify_order_changed(*[u[2] for u in updates])
+
+    if active is not None:
+        _status_poller_last_sync = time.monotonic()
+        with db() as conn:
+            conn.execute('''
+                INSERT INTO settings (key, value) VALUES ('status_poller_synced_at', ?)
+                ON CONFLICT(key) DO UPDATE SET value = excluded.value
+            ''', (str(time.time()),))
+    return len(updates)
+
+def run_status_poller():
+    print(f"Starting status poller (every {STATUS_POLL_INTERVAL}s)...")
+    while True:
+        try:
+            sync_waiting_orders()
+        except Exception as e:
+            print(f"Status poller error: {e}")
+        time.sleep(STATUS_POLL_INTERVAL)
+
+if HERO_SMS_API_KEY and BACKGROUND_LEADER and STATUS_POLL_INTERVAL > 0:
+    status_poller_thread = threading.Thread(target=run_status_poller)
+    status_poller_thread.daemon = True
+    status_poller_thread.start()
+
+# --- Quota ---
+# A purchase reserves quota up front with one conditional UPDATE, so concurrent requests
+# can't push used_numbers past allowed_numbers. Writing the order row commits the
+# reservation; if the purchase fails it is handed back with release_quota().
+
+def reserve_quota(conn, user_id, count=1):
+    """Take `count` numbers from the user's quota; False if that would exceed it."""
+    conn.execute('INSERT OR IGNORE INTO quotas (user_id, allowed_numbers, used_numbers) VALUES (?, 0, 0)', (user_id,))
+    return conn.execute(
+        'UPDATE quotas SET used_numbers = used_numbers + ? WHERE user_id = ? AND used_numbers + ? <= allowed_numbers',
+        (count, user_id, count)
+    ).rowcount == 1
+
+def release_quota(conn, user_id, count=1):
+    conn.execute('UPDATE quotas SET used_numbers = MAX(used_numbers - ?, 0) WHERE user_id = ?', (count, user_id))
+
+def cancel_order_row(conn, order_id):
+    """Mark an order cancelled, refunding its quota only on the waiting -> cancelled
+    transition so racing cancels can't refund twice. Returns True if it was refunded."""
+    order = conn.execute('SELECT user_id FROM orders WHERE order_id_provider = ?', (order_id,)).fetchone()
+    refunded = conn.execute("UPDATE orders SET status = 'cancelled' WHERE order_id_provider = ? AND status = 'waiting'",
+                            (order_id,)).rowcount > 0
+    conn.execute("UPDATE orders SET status = 'cancelled' WHERE order_id_provider = ? AND status != 'cancelled'", (order_id,))
+    if refunded and order and order['user_id']:
+        release_quota(conn, order['user_id'])
+    return refunded
+
+def apply_provider_status(conn, order_id, status, sms_code):
+    """Move a waiting order to the status getStatusV2 reported. Returns True if it changed.
+    Cancelled or expired without an SMS means the number was never used, so the quota is
+    released on that transition, whichever path (poller or status endpoint) noticed it."""
+    if status == 'waiting':
+        return False
+    order = conn.execute('SELECT user_id FROM orders WHERE order_id_provider = ?', (order_id,)).fetchone()
+    changed = conn.execute("UPDATE orders SET status = ?, sms_code = ? WHERE order_id_provider = ? AND status = 'waiting'",
+                           (status, sms_code, order_id)).rowcount > 0
+    if changed and status == 'cancelled' and order and order['user_id']:
+        release_quota(conn, order['user_id'])
+    return changed
+
+def abandon_activation(order_id, error):
+    """Compensation for a purchase whose order row couldn't be written: queue the
+    activation to be given back to the provider so we aren't billed for a number nobody
+    can see. HeroSMS refuses cancels in the first 2 minutes, so cancel_orphaned_activations()
+    does it later; if even the queue can't be written it is kept in memory until it can."""
+    print(f"Could not record activation {order_id} ({error}); cancelling it at the provider once allowed")
+    with _orphans_lock:
+        _orphans_unsaved.append((str(order_id), str(error)[:200], time.time()))
+    try:
+        save_orphaned_activations()
+    except sqlite3.Error as e:
+        print(f"Could not queue orphaned activation {order_id} ({e}); will retry")
+
 @app.route('/api/generate-number', methods=['POST'])
-@token_required
+@token_required(fresh=True)
 def generate_number(current_user):
     data = request.get_json()
     service_id = data.get('service_id') # e.g. 'wa'
@@ -470,61 +1597,64 @@ def generate_number(current_user):
     if not service_id or not country_id:
         return jsonify({'message': 'Service ID and Country ID are required!'}), 400
 
-    conn = get_db_connection()
-
-    # Check Whitelist
-    setting = conn.execute("SELECT value FROM settings WHERE key = 'whitelist_required'").fetchone()
-    whitelist_required = setting and setting['value'] == '1'
-
-    if whitelist_required:
-        whitelisted = conn.execute('SELECT 1 FROM user_whitelist WHERE user_id = ? AND service_id = ? AND country_id = ?',
-                                  (current_user['id'], service_id, country_id)).fetchone()
-        if not whitelisted:
-            conn.close()
-            return jsonify({'message': f'Service {service_id} for country {country_id} is not whitelisted for your account.'}), 403
-
-    quota = conn.execute('SELECT * FROM quotas WHERE user_id = ?', (current_user['id'],)).fetchone()
-    if quota is None:
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO quotas (user_id, allowed_numbers, used_numbers) VALUES (?, 0, 0)',
-            (current_user['id'],)
-        )
-        conn.commit()
-        quota = conn.execute('SELECT * FROM quotas WHERE user_id = ?', (current_user['id'],)).fetchone()
-
-    if quota['used_numbers'] >= quota['allowed_numbers']:
-        conn.close()
-        return jsonify({'message': 'Quota exceeded! Please contact admin to increase your limit.'}), 403
+    with db() as conn:
+        # Check Whitelist
+        setting = conn.execute("SELECT value FROM settings WHERE key = 'whitelist_required'").fetchone()
+        whitelist_required = setting and setting['value'] == '1'
+
+        if whitelist_required:
+            whitelisted = conn.execute('SELECT 1 FROM user_whitelist WHERE user_id = ? AND service_id = ? AND country_id = ?',
+                                      (current_user['id'], service_id, country_id)).fetchone()
+            if not whitelisted:
+                return jsonify({'message': f'Service {service_id} for country {country_id} is not whitelisted for your account.'}), 403
+
+        if not reserve_quota(conn, current_user['id']):
+            return jsonify({'message': 'Quota exceeded! Please contact admin to increase your limit.'}), 403
+
+        warm = take_warm_number(conn, service_id, country_id)
+        if warm:
+            conn.execute('''
+                INSERT INTO orders (user_id, service_id, country_id, phone_number, order_id_provider, status)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (current_user['id'], service_id, country_id, warm['phone_number'], warm['order_id_provider'], 'waiting'))
+
+    if warm:
+        notify_order_changed(warm['order_id_provider'])
+        return jsonify({
+            'order_id': warm['order_id_provider'],
+            'phone_number': warm['phone_number'],
+            'status': 'waiting'
+        })
 
     # Map frontend IDs to Provider IDs
     p_service = get_mapping(service_id, 'service')
     p_country = get_mapping(country_id, 'country')
 
-    # For testing without real API key, allow simulation
-    if not HERO_SMS_API_KEY:
-        import random
-        res = {
-            "activationId": str(random.randint(100000, 999999)),
-            "phoneNumber": f"1{random.randint(2000000000, 9999999999)}"
-        }
-    else:
+    try:
         # Call Hero-SMS API V2
         res = get_number_with_smart_pricing(p_service, p_country)
+    except Exception:
+        with db() as conn:
+            release_quota(conn, current_user['id'])
+        raise
 
     if isinstance(res, dict) and 'activationId' in res:
         order_id = res['activationId']
         phone_number = res['phoneNumber']
 
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO orders (user_id, service_id, country_id, phone_number, order_id_provider, status)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (current_user['id'], service_id, country_id, phone_number, order_id, 'waiting'))
-
-        cursor.execute('UPDATE quotas SET used_numbers = used_numbers + 1 WHERE user_id = ?', (current_user['id'],))
-        conn.commit()
-        conn.close()
+        # The reserved quota stays spent now that the order exists
+        try:
+            with db() as conn:
+                conn.execute('''
+                    INSERT INTO orders (user_id, service_id, country_id, phone_number, order_id_provider, status)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (current_user['id'], service_id, country_id, phone_number, order_id, 'waiting'))
+        except sqlite3.Error as e:
+            abandon_activation(order_id, e)
+            with db() as conn:
+                release_quota(conn, current_user['id'])
+            return jsonify({'message': 'Could not record the order, please try again.'}), 503
+        notify_order_changed(order_id)
 
         return jsonify({
             'order_id': order_id,
@@ -532,18 +1662,430 @@ def generate_number(current_user):
             'status': 'waiting'
         })
     else:
-        conn.close()
+        with db() as conn:
+            release_quota(conn, current_user['id'])
         msg = res.get('details', 'Failed to generate number from provider') if isinstance(res, dict) else str(res)
         return jsonify({'message': msg, 'provider_response': res}), 500
 
+# Bulk ordering for resellers: one auth/whitelist/quota pass for the whole batch,
+# provider calls fanned out over a small pool, and per-item results.
+BULK_MAX_NUMBERS = int(os.environ.get('BULK_MAX_NUMBERS', '50'))
+BULK_WORKERS = int(os.environ.get('BULK_WORKERS', '8'))
+
+def _acquire_number(service_id, country_id):
+    p_service = get_mapping(service_id, 'service')
+    p_country = get_mapping(country_id, 'country')
+    return get_number_with_smart_pricing(p_service, p_country)
+
+@app.route('/api/generate-numbers', methods=['POST'])
+@token_required(fresh=True)
+def generate_numbers(current_user):
+    """Body: {"items": [{"service_id": "wa", "country_id": "KE", "count": 3}, ...]}.
+    The whole batch's quota is reserved up front; numbers the provider can't supply are
+    refunded and reported per item."""
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'message': 'items must be a non-empty list!'}), 400
+
+    # Every item is at least one number; check the limit before expanding counts
+    if len(items) > BULK_MAX_NUMBERS:
+        return jsonify({'message': f'At most {BULK_MAX_NUMBERS} numbers per request!'}), 400
+
+    wanted = []  # one (service_id, country_id) per number
+    try:
+        for item in items:
+            if not isinstance(item, dict):
+                raise TypeError
+            service_id, country_id = item['service_id'], item['country_id']
+            count = int(item.get('count', 1))
+            if not isinstance(service_id, str) or not isinstance(country_id, str):
+                raise TypeError
+            if not service_id or not country_id or count < 1:
+                raise ValueError
+            if len(wanted) + count > BULK_MAX_NUMBERS:
+                return jsonify({'message': f'At most {BULK_MAX_NUMBERS} numbers per request!'}), 400
+            wanted.extend([(service_id, country_id)] * count)
+    except (KeyError, TypeError, ValueError, OverflowError):
+        return jsonify({'message': 'Each item needs service_id, country_id and a positive count!'}), 400
+
+    user_id = current_user['id']
+    with db() as conn:
+        setting = conn.execute("SELECT value FROM settings WHERE key = 'whitelist_required'").fetchone()
+        if setting and setting['value'] == '1':
+            for service_id, country_id in dict.fromkeys(wanted):
+                whitelisted = conn.execute('SELECT 1 FROM user_whitelist WHERE user_id = ? AND service_id = ? AND country_id = ?',
+                                          (user_id, service_id, country_id)).fetchone()
+                if not whitelisted:
+                    return jsonify({'message': f'Service {service_id} for country {country_id} is not whitelisted for your account.'}), 403
+
+        if not reserve_quota(conn, user_id, len(wanted)):
+            return jsonify({'message': f'Quota exceeded! This batch needs {len(wanted)} numbers.'}), 403
+
+    timings = _request_timings.get()
+
+    def acquire(pair):
+        # Pool threads start with an empty context; report into this request's Server-Timing
+        _request_timings.set(timings)
+        try:
+            return _acquire_number(*pair)
+        except Exception as e:
+            return {'error': 'EXCEPTION', 'details': str(e)}
+
+    with ThreadPoolExecutor(max_workers=min(BULK_WORKERS, len(wanted))) as pool:
+        responses = list(pool.map(acquire, wanted))
+
+    results = []
+    bought = []
+    for (service_id, country_id), res in zip(wanted, responses):
+        if isinstance(res, dict) and 'activationId' in res:
+            bought.append((user_id, service_id, country_id, res['phoneNumber'], res['activationId'], 'waiting'))
+            results.append({'service_id': service_id, 'country_id': country_id, 'order_id': res['activationId'],
+                            'phone_number': res['phoneNumber'], 'status': 'waiting'})
+        else:
+            msg = res.get('details', 'Failed to generate number from provider') if isinstance(res, dict) else str(res)
+            results.append({'service_id': service_id, 'country_id': country_id, 'status': 'failed', 'message': msg})
+
+    try:
+        with db() as conn:
+            conn.executemany('''
+                INSERT INTO orders (user_id, service_id, country_id, phone_number, order_id_provider, status)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', bought)
+            if len(bought) < len(wanted):
+                release_quota(conn, user_id, len(wanted) - len(bought))
+    except sqlite3.Error as e:
+        for row in bought:
+            abandon_activation(row[4], e)
+        with db() as conn:
+            release_quota(conn, user_id, len(wanted))
+        return jsonify({'message': 'Could not record the orders, please try again.'}), 503
+
+    if bought:
+        notify_order_changed(*[row[4] for row in bought])
+    return jsonify({'ordered': len(bought), 'failed': len(wanted) - len(bought), 'results': results}), 200 if bought else 500
+
+# --- Warm inventory ---
+# For the busiest pairs a background task keeps a few activations bought ahead of time
+# (WARM_INVENTORY="wa@KE:2,tg@US:1") so generate_number can hand one out without waiting
+# on the escalator. HeroSMS refuses cancels in an activation's first 2 minutes and stops
+# refunding after 20, so unsold numbers are cancelled once they are WARM_MAX_AGE old.
+
+def _parse_warm_inventory(spec):
+    pairs = {}
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        try:
+            pair, count = entry.split(':')
+            service_id, country_id = pair.split('@')
+            pairs[(service_id.strip(), country_id.strip())] = int(count)
+        except ValueError:
+            print(f"Ignoring malformed WARM_INVENTORY entry: {entry!r}")
+    return pairs
+
+WARM_INVENTORY = _parse_warm_inventory(os.environ.get('WARM_INVENTORY', ''))
+WARM_MAX_AGE = max(int(os.environ.get('WARM_MAX_AGE', '300')), 150)
+WARM_REFILL_INTERVAL = 15
+
+# Per-process counters for tuning the pair sizes: hit rate and spend lost to failed cancels
+warm_stats = {'hits': 0, 'misses': 0, 'acquired': 0, 'cancelled': 0, 'cancel_failed': 0, 'wasted_spend': 0.0}
+_warm_stats_lock = threading.Lock()
+
+def _count_warm(key, amount=1):
+    with _warm_stats_lock:
+        warm_stats[key] += amount
+
+def take_warm_number(conn, service_id, country_id):
+    """Claim a pre-bought activation for the pair, or None. Runs inside the caller's transaction."""
+    if (service_id, country_id) not in WARM_INVENTORY:
+        return None
+    fresh_after = time.time() - WARM_MAX_AGE
+    while True:
+        row = conn.execute('''
+            SELECT * FROM warm_numbers WHERE service_id = ? AND country_id = ? AND acquired_at > ?
+            ORDER BY acquired_at LIMIT 1
+        ''', (service_id, country_id, fresh_after)).fetchone()
+        if row is None:
+            _count_warm('misses')
+            return None
+        # Another request or the expiry pass may have claimed it first
+        if conn.execute('DELETE FROM warm_numbers WHERE order_id_provider = ?', (row['order_id_provider'],)).rowcount:
+            _count_warm('hits')
+            return dict(row)
+
+def expire_warm_numbers():
+    """Cancel activations that were not handed out in time."""
+    with db() as conn:
+        rows = conn.execute('SELECT * FROM warm_numbers WHERE acquired_at <= ?', (time.time() - WARM_MAX_AGE,)).fetchall()
+    for row in rows:
+        with db() as conn:
+            if not conn.execute('DELETE FROM warm_numbers WHERE order_id_provider = ?', (row['order_id_provider'],)).rowcount:
+                continue
+        res = call_hero_api('cancelActivation', id=row['order_id_provider'])
+        if cancel_accepted(res):
+            _count_warm('cancelled')
+        else:
+            print(f"Could not cancel warm activation {row['order_id_provider']}: {res}")
+            _count_warm('cancel_failed')
+            _count_warm('wasted_spend', row['cost'] or 0.0)
+
+def refill_warm_inventory():
+    fresh_after = time.time() - WARM_MAX_AGE
+    for (service_id, country_id), target in WARM_INVENTORY.items():
+        with db() as conn:
+            have = conn.execute('SELECT COUNT(*) FROM warm_numbers WHERE service_id = ? AND country_id = ? AND acquired_at > ?',
+                                (service_id, country_id, fresh_after)).fetchone()[0]
+        for _ in range(target - have):
+            res = _acquire_number(service_id, country_id)
+            if not (isinstance(res, dict) and 'activationId' in res):
+                break  # out of stock or over budget; try again next round
+            cost = res.get('activationCost')
+            if cost is None:
+                cost = (get_cached_price(get_mapping(service_id, 'service'), get_mapping(country_id, 'country')) or {}).get('cost')
+            try:
+                with db() as conn:
+                    conn.execute('''
+                        INSERT INTO warm_numbers (order_id_provider, service_id, country_id, phone_number, cost, acquired_at)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', (res['activationId'], service_id, country_id, res['phoneNumber'], cost, time.time()))
+            except sqlite3.Error as e:
+                abandon_activation(res['activationId'], e)
+                break
+            _count_warm('acquired')
+
+def run_warm_inventory():
+    print(f"Starting warm inventory for {', '.join(f'{s}@{c}:{n}' for (s, c), n in WARM_INVENTORY.items())}...")
+    while True:
+        try:
+            expire_warm_numbers()
+            refill_warm_inventory()
+        except Exception as e:
+            print(f"Warm inventory error: {e}")
+        time.sleep(WARM_REFILL_INTERVAL)
+
+if HERO_SMS_API_KEY and BACKGROUND_LEADER and WARM_INVENTORY:
+    warm_inventory_thread = threading.Thread(target=run_warm_inventory)
+    warm_inventory_thread.daemon = True
+    warm_inventory_thread.start()
+
+# --- Stale order sweeper ---
+# Orders nobody polls or cancels would otherwise stay 'waiting' with their quota spent.
+# Past STALE_ORDER_AGE seconds they are cancelled at the provider (concurrently, on a small
+# pool) and the confirmed ones are refunded together in one transaction. The default stays
+# under HeroSMS's 20 minute refund window and never goes below its 2 minute cancel lock.
+# Replies saying the activation is already over (cancelled, unknown, past the refund window)
+# are final, so those orders are closed and refunded too. If a code arrived that we never
+# recorded, it is fetched and stored instead; anything else is retried next pass.
+
+STALE_ORDER_AGE = max(int(os.environ.get('STALE_ORDER_AGE', '900')), 150)
+STALE_SWEEP_INTERVAL = int(os.environ.get('STALE_SWEEP_INTERVAL', '60'))
+STALE_SWEEP_WORKERS = 4
+
+_sweep_lock = threading.Lock()
+
+HERO_CANCEL_GONE = {'CANCELED', 'FREE_CANCELLATION_EXPIRED'} | HERO_UNKNOWN_ACTIVATION
+HERO_OTP_RECEIVED = {'OTP_RECEIVED', 'NEW_OTP_RECEIVED'}
+
+def _cancel_failure_reason(res):
+    if isinstance(res, dict):
+        return str(res.get('title') or res.get('error') or res.get('status') or res)[:60]
+    return str(res)[:60]
+
+def sweep_stale_orders(max_age=STALE_ORDER_AGE):
+    """Cancel and refund waiting orders older than max_age seconds. Returns a summary dict,
+    or None if another sweep in this process is still running."""
+    if not _sweep_lock.acquire(blocking=False):
+        return None
+    try:
+        with db() as conn:
+            stale = [row['order_id_provider'] for row in conn.execute(
+                "SELECT order_id_provider FROM orders WHERE status = 'waiting' AND timestamp <= datetime('now', ?)",
+                (f'-{int(max_age)} seconds',)
+            ).fetchall()]
+        summary = {'found': len(stale), 'cancelled': 0, 'gone': 0, 'received': 0, 'refunded': 0, 'failed': {}}
+        if not stale:
+            return summary
+
+        def cancel(order_id):
+            try:
+                return call_hero_api('cancelActivation', id=order_id)
+            except Exception as e:
+                return f"EXCEPTION: {e}"
+
+        with ThreadPoolExecutor(max_workers=min(STALE_SWEEP_WORKERS, len(stale))) as pool:
+            responses = list(pool.map(cancel, stale))
+
+        cancelled, gone, received = [], [], []
+        for order_id, res in zip(stale, responses):
+            reason = _cancel_failure_reason(res)
+            if cancel_accepted(res):
+                cancelled.append(order_id)
+            elif reason in HERO_CANCEL_GONE:
+                gone.append(order_id)
+            elif reason in HERO_OTP_RECEIVED:
+                # The number was used: record the code rather than cancel, and don't refund
+                status, sms_code = parse_status_v2(call_hero_api('getStatusV2', id=order_id))
+                if status == 'received':
+                    received.append((sms_code, order_id))
+                else:
+                    summary['failed'][reason] = summary['failed'].get(reason, 0) + 1
+            else:
+                summary['failed'][reason] = summary['failed'].get(reason, 0) + 1
+
+        if received:
+            with db() as conn:
+                conn.executemany("UPDATE orders SET status = 'received', sms_code = ? WHERE order_id_provider = ? AND status = 'waiting'",
+                                 received)
+            notify_order_changed(*[order_id for _, order_id in received])
+
+        if cancelled or gone:
+            with db() as conn:
+                summary['refunded'] = sum(cancel_order_row(conn, order_id) for order_id in cancelled + gone)
+            notify_order_changed(*cancelled, *gone)
+        summary['cancelled'] = len(cancelled)
+        summary['gone'] = len(gone)
+        summary['received'] = len(received)
+        return summary
+    finally:
+        _sweep_lock.release()
+
+def run_stale_sweeper():
+    print(f"Starting stale order sweeper (orders older than {STALE_ORDER_AGE}s, every {STALE_SWEEP_INTERVAL}s)...")
+    while True:
+        try:
+            summary = sweep_stale_orders()
+            if summary and summary['found']:
+                print(f"Stale order sweep: {summary}")
+        except Exception as e:
+            print(f"Stale order sweeper error: {e}")
+        time.sleep(STALE_SWEEP_INTERVAL)
+
+if HERO_SMS_API_KEY and BACKGROUND_LEADER and STALE_SWEEP_INTERVAL > 0:
+    stale_sweeper_thread = threading.Thread(target=run_stale_sweeper)
+    stale_sweeper_thread.daemon = True
+    stale_sweeper_thread.start()
+
+# --- Orphaned activations ---
+# Activations bought for an order, warm slot or regen whose row then failed to write.
+# They wait in orphaned_activations until HeroSMS's 2 minute cancel lock has passed and
+# are cancelled from there; replies that won't change on retry drop them from the queue.
+
+ORPHAN_CANCEL_AFTER = 130
+ORPHAN_REAP_INTERVAL = 30
+
+_orphans_unsaved = []
+_orphans_lock = threading.Lock()
+
+def save_orphaned_activations():
+    """Move orphans recorded in this process into the shared queue table."""
+    with _orphans_lock:
+        pending = list(_orphans_unsaved)
+    if not pending:
+        return
+    with db() as conn:
+        conn.executemany('INSERT OR IGNORE INTO orphaned_activations (order_id_provider, reason, abandoned_at) VALUES (?, ?, ?)',
+                         pending)
+    with _orphans_lock:
+        del _orphans_unsaved[:len(pending)]
+
+def cancel_orphaned_activations():
+    """Cancel queued orphans that are past the cancel lock. Returns the number cancelled."""
+    save_orphaned_activations()
+    with db() as conn:
+        due = [row['order_id_provider'] for row in conn.execute(
+            'SELECT order_id_provider FROM orphaned_activations WHERE abandoned_at <= ? ORDER BY abandoned_at',
+            (time.time() - ORPHAN_CANCEL_AFTER,)
+        ).fetchall()]
+    cancelled = 0
+    for order_id in due:
+        res = call_hero_api('cancelActivation', id=order_id)
+        reason = _cancel_failure_reason(res)
+        if cancel_accepted(res):
+            cancelled += 1
+        elif reason in HERO_CANCEL_GONE or reason in HERO_OTP_RECEIVED:
+            print(f"Orphaned activation {order_id} can no longer be cancelled: {reason}")
+        else:
+            continue  # transient; next pass
+        with db() as conn:
+            conn.execute('DELETE FROM orphaned_activations WHERE order_id_provider = ?', (order_id,))
+    return cancelled
+
+def run_orphan_reaper():
+    while True:
+        try:
+            # Every process flushes its own unsaved orphans; only the leader cancels
+            if BACKGROUND_LEADER:
+                cancel_orphaned_activations()
+            else:
+                save_orphaned_activations()
+        except Exception as e:
+            print(f"Orphaned activation reaper error: {e}")
+        time.sleep(ORPHAN_REAP_INTERVAL)
+
+if HERO_SMS_API_KEY:
+    orphan_reaper_thread = threading.Thread(target=run_orphan_reaper)
+    orphan_reaper_thread.daemon = True
+    orphan_reaper_thread.start()
+
+ORDERS_PAGE_DEFAULT = 50
+ORDERS_PAGE_MAX = 200
+
+def orders_change_seq(conn):
+    row = conn.execute("SELECT value FROM settings WHERE key = 'orders_change_seq'").fetchone()
+    return int(row['value']) if row else 0
+
 @app.route('/api/orders', methods=['GET'])
 @token_required
 def get_orders(current_user):
-    conn = get_db_connection()
-    orders = conn.execute('SELECT * FROM orders WHERE user_id = ? ORDER BY timestamp DESC', (current_user['id'],)).fetchall()
-    conn.close()
+    """Without parameters: the full history, newest first (kept for old clients).
+
+    ?limit=N[&before=<timestamp>,<id>]  one page, newest first; follow next_before for older ones.
+    ?since=<seq>[&limit=N]               only orders changed after change sequence <seq>;
+                                         call again with the returned seq while more is true.
+    Both paged forms return {'orders': [...], 'seq': ..., ...}.
+    """
+    args = request.args
+    if not ('limit' in args or 'before' in args or 'since' in args):
+        with db() as conn:
+            orders = conn.execute('SELECT * FROM orders WHERE user_id = ? ORDER BY timestamp DESC, id DESC', (current_user['id'],)).fetchall()
+        return jsonify([dict(order) for order in orders])
 
-    return jsonify([dict(order) for order in orders])
+    try:
+        limit = min(max(int(args.get('limit', ORDERS_PAGE_DEFAULT)), 1), ORDERS_PAGE_MAX)
+        since = int(args['since']) if 'since' in args else None
+        before = None
+        if 'before' in args:
+            ts, order_pk = args['before'].rsplit(',', 1)
+            before = (ts, int(order_pk))
+    except ValueError:
+        return jsonify({'message': 'Invalid pagination parameters'}), 400
+
+    with db() as conn:
+        if since is not None:
+            rows = conn.execute('SELECT * FROM orders WHERE user_id = ? AND change_seq > ? ORDER BY change_seq LIMIT ?',
+                                (current_user['id'], since, limit)).fetchall()
+            return jsonify({
+                'orders': [dict(r) for r in rows],
+                'seq': rows[-1]['change_seq'] if rows else since,
+                'more': len(rows) == limit,
+            })
+
+        # Read the sequence first: anything that changes after it shows up in the next delta
+        seq = orders_change_seq(conn)
+        if before:
+            rows = conn.execute('SELECT * FROM orders WHERE user_id = ? AND (timestamp, id) < (?, ?) ORDER BY timestamp DESC, id DESC LIMIT ?',
+                                (current_user['id'], before[0], before[1], limit)).fetchall()
+        else:
+            rows = conn.execute('SELECT * FROM orders WHERE user_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?',
+                                (current_user['id'], limit)).fetchall()
+
+    return jsonify({
+        'orders': [dict(r) for r in rows],
+        'seq': seq,
+        'next_before': f"{rows[-1]['timestamp']},{rows[-1]['id']}" if len(rows) == limit else None,
+    })
 
 @app.route('/api/direct/generate', methods=['POST'])
 def direct_generate():
@@ -555,43 +2097,42 @@ def direct_generate():
     if not token or not service_id or not country_id:
         return jsonify({'message': 'Missing parameters!'}), 400
 
-    conn = get_db_connection()
-    # Validate token
-    p_token = conn.execute('SELECT * FROM purchase_tokens WHERE token = ? AND is_used = 0', (token,)).fetchone()
-    if not p_token:
-        conn.close()
+    # Claim the token before going to the provider so two tabs can't both spend it
+    with db() as conn:
+        claimed = conn.execute('UPDATE purchase_tokens SET is_used = 1 WHERE token = ? AND is_used = 0', (token,)).rowcount
+    if not claimed:
         return jsonify({'message': 'Invalid or expired token!'}), 403
 
     # Map frontend IDs to Provider IDs
     p_service = get_mapping(service_id, 'service')
     p_country = get_mapping(country_id, 'country')
 
-    # For testing without real API key, allow simulation
-    if not HERO_SMS_API_KEY:
-        import random
-        res = {
-            "activationId": str(random.randint(100000, 999999)),
-            "phoneNumber": f"1{random.randint(2000000000, 9999999999)}"
-        }
-    else:
+    try:
         # Call Hero-SMS API V2
         res = get_number_with_smart_pricing(p_service, p_country)
+    except Exception:
+        with db() as conn:
+            conn.execute('UPDATE purchase_tokens SET is_used = 0 WHERE token = ?', (token,))
+        raise
 
     if isinstance(res, dict) and 'activationId' in res:
         order_id = res['activationId']
         phone_number = res['phoneNumber']
 
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO orders (service_id, country_id, phone_number, order_id_provider, status, token)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (service_id, country_id, phone_number, order_id, 'waiting', token))
-
-        # Mark token as used
-        cursor.execute('UPDATE purchase_tokens SET is_used = 1, service_id = ?, country_id = ? WHERE token = ?',
-                       (service_id, country_id, token))
-        conn.commit()
-        conn.close()
+        try:
+            with db() as conn:
+                conn.execute('''
+                    INSERT INTO orders (service_id, country_id, phone_number, order_id_provider, status, token)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (service_id, country_id, phone_number, order_id, 'waiting', token))
+                conn.execute('UPDATE purchase_tokens SET service_id = ?, country_id = ? WHERE token = ?',
+                             (service_id, country_id, token))
+        except sqlite3.Error as e:
+            abandon_activation(order_id, e)
+            with db() as conn:
+                conn.execute('UPDATE purchase_tokens SET is_used = 0 WHERE token = ?', (token,))
+            return jsonify({'message': 'Could not record the order, please try again.'}), 503
+        notify_order_changed(order_id)
 
         return jsonify({
             'order_id': order_id,
@@ -599,7 +2140,8 @@ def direct_generate():
             'status': 'waiting'
         })
     else:
-        conn.close()
+        with db() as conn:
+            conn.execute('UPDATE purchase_tokens SET is_used = 0 WHERE token = ?', (token,))
         msg = res.get('details', 'Failed to generate number from provider') if isinstance(res, dict) else str(res)
         return jsonify({'message': msg, 'provider_response': res}), 500
 
@@ -612,41 +2154,37 @@ def direct_status():
         return jsonify({'message': 'Missing parameters!'}), 400
 
     # Verify order belongs to token
-    conn = get_db_connection()
-    order = conn.execute('SELECT * FROM orders WHERE order_id_provider = ? AND token = ?', (order_id, token)).fetchone()
-    conn.close()
+    seq = order_events.seq
+    with db() as conn:
+        order = conn.execute('SELECT * FROM orders WHERE order_id_provider = ? AND token = ?', (order_id, token)).fetchone()
 
     if not order:
         return jsonify({'message': 'Order not found for this token!'}), 404
 
-    # Simulation for testing
-    if not HERO_SMS_API_KEY:
-        import random
-        if random.random() > 0.7:
-             res = {"sms": {"code": str(random.randint(100000, 999999))}}
-        else:
-             res = "STATUS_WAIT_CODE"
-    else:
-        # Reuse status logic
-        res = call_hero_api('getStatusV2', id=order_id)
+    # The background poller or provider webhook keeps the row current, so answer from the database;
+    # a received or cancelled order is final either way
+    if order_rows_are_current(_waiting_seconds(order)) or order['status'] != 'waiting':
+        def still_waiting():
+            with db() as conn:
+                return conn.execute("SELECT 1 FROM orders WHERE order_id_provider = ? AND token = ? AND status = 'waiting'",
+                                    (order_id, token)).fetchone() is not None
+        if order['status'] == 'waiting' and wait_for_order_update(order_id, _requested_wait(), seq, still_waiting):
+            with db() as conn:
+                order = conn.execute('SELECT * FROM orders WHERE order_id_provider = ? AND token = ?', (order_id, token)).fetchone()
+        return jsonify({
+            'order_id': order_id,
+            'status': order['status'],
+            'sms_code': order['sms_code']
+        })
 
-    status = 'waiting'
-    sms_code = None
+    res = call_hero_api('getStatusV2', id=order_id)
 
-    if isinstance(res, dict) and res.get('sms') and res['sms'].get('code'):
-        status = 'received'
-        sms_code = res['sms']['code']
-    elif res == "STATUS_WAIT_CODE":
-        status = 'waiting'
-    elif res == "STATUS_CANCEL" or (isinstance(res, dict) and res.get('title') == 'CANCELED'):
-        status = 'cancelled'
-
-    # Update local DB
-    conn = get_db_connection()
-    conn.execute('UPDATE orders SET status = ?, sms_code = ? WHERE order_id_provider = ? AND token = ?',
-                 (status, sms_code, order_id, token))
-    conn.commit()
-    conn.close()
+    status, sms_code = parse_status_v2(res)
+
+    with db() as conn:
+        changed = apply_provider_status(conn, order_id, status, sms_code)
+    if changed:
+        notify_order_changed(order_id)
 
     return jsonify({
         'order_id': order_id,
@@ -655,48 +2193,39 @@ def direct_status():
     })
 
 @app.route('/api/order/<order_id>/cancel', methods=['POST'])
-@token_required
+@token_required(fresh=True)
 def cancel_order(current_user, order_id):
-    if not HERO_SMS_API_KEY:
-        res = "ACCESS_CANCEL"
-    else:
-        # cancelActivation — cancel activation (return money)
-        res = call_hero_api('cancelActivation', id=order_id)
+    with db() as conn:
+        order = conn.execute('SELECT 1 FROM orders WHERE order_id_provider = ? AND user_id = ?', (order_id, current_user['id'])).fetchone()
+    if not order:
+        return jsonify({'message': 'Order not found'}), 404
 
-    if res == "ACCESS_CANCEL" or (isinstance(res, dict) and res.get('status') == 'SUCCESS'): # Allow simulation
-        conn = get_db_connection()
-        order = conn.execute('SELECT * FROM orders WHERE order_id_provider = ? AND user_id = ?', (order_id, current_user['id'])).fetchone()
-        if order:
-            cursor = conn.cursor()
-            cursor.execute('UPDATE orders SET status = ? WHERE order_id_provider = ?', ('cancelled', order_id))
-            if order['status'] == 'waiting':
-                cursor.execute('UPDATE quotas SET used_numbers = used_numbers - 1 WHERE user_id = ?', (current_user['id'],))
-            conn.commit()
-        conn.close()
+    # cancelActivation — cancel activation (return money)
+    res = call_hero_api('cancelActivation', id=order_id)
+
+    if cancel_accepted(res):
+        with db() as conn:
+            cancel_order_row(conn, order_id)
+        notify_order_changed(order_id)
         return jsonify({'message': 'Order cancelled.'})
     else:
         return jsonify({'message': f'Failed to cancel order: {res}'}), 400
 
 @app.route('/api/admin/order/<order_id>/cancel', methods=['POST'])
-@token_required
+@token_required(fresh=True)
 def admin_cancel_order(current_user, order_id):
     if current_user.get('username') != 'admin':
         return jsonify({'message': 'Unauthorized'}), 403
-    conn = get_db_connection()
-    order = conn.execute('SELECT * FROM orders WHERE order_id_provider = ?', (order_id,)).fetchone()
+    with db() as conn:
+        order = conn.execute('SELECT 1 FROM orders WHERE order_id_provider = ?', (order_id,)).fetchone()
     if not order:
-        conn.close()
         return jsonify({'message': 'Order not found'}), 404
-    res = call_hero_api('cancelActivation', id=order_id) if HERO_SMS_API_KEY else "ACCESS_CANCEL"
-    if res == "ACCESS_CANCEL" or (isinstance(res, dict) and res.get('status') == 'SUCCESS'):
-        cursor = conn.cursor()
-        cursor.execute('UPDATE orders SET status = ? WHERE order_id_provider = ?', ('cancelled', order_id))
-        if order['status'] == 'waiting' and order['user_id']:
-            cursor.execute('UPDATE quotas SET used_numbers = used_numbers - 1 WHERE user_id = ?', (order['user_id'],))
-        conn.commit()
-        conn.close()
+    res = call_hero_api('cancelActivation', id=order_id)
+    if cancel_accepted(res):
+        with db() as conn:
+            cancel_order_row(conn, order_id)
+        notify_order_changed(order_id)
         return jsonify({'message': 'Cancelled by admin.'})
-    conn.close()
     return jsonify({'message': f'Provider cancel failed: {res}'}), 400
 
 @app.route('/api/direct/cancel', methods=['POST'])
@@ -708,19 +2237,20 @@ def direct_cancel():
     if not token or not order_id:
         return jsonify({'message': 'Missing parameters!'}), 400
 
-    if not HERO_SMS_API_KEY:
-        res = "ACCESS_CANCEL"
-    else:
-        # cancelActivation — cancel activation (return money)
-        res = call_hero_api('cancelActivation', id=order_id)
+    with db() as conn:
+        order = conn.execute('SELECT 1 FROM orders WHERE order_id_provider = ? AND token = ?', (order_id, token)).fetchone()
+    if not order:
+        return jsonify({'message': 'Order not found'}), 404
 
-    if res == "ACCESS_CANCEL" or (isinstance(res, dict) and res.get('status') == 'SUCCESS'): # Allow simulation
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('UPDATE orders SET status = ? WHERE order_id_provider = ? AND token = ?', ('cancelled', order_id, token))
-        cursor.execute('UPDATE purchase_tokens SET is_used = 0 WHERE token = ?', (token,))
-        conn.commit()
-        conn.close()
+    # cancelActivation — cancel activation (return money)
+    res = call_hero_api('cancelActivation', id=order_id)
+
+    if cancel_accepted(res):
+        with db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE orders SET status = ? WHERE order_id_provider = ? AND token = ?', ('cancelled', order_id, token))
+            cursor.execute('UPDATE purchase_tokens SET is_used = 0 WHERE token = ?', (token,))
+        notify_order_changed(order_id)
         return jsonify({'message': 'Order cancelled. You can try another number.'})
     else:
         return jsonify({'message': f'Failed to cancel order: {res}'}), 400
@@ -728,34 +2258,40 @@ def direct_cancel():
 @app.route('/api/order/<order_id>/status', methods=['GET'])
 @token_required
 def get_order_status(current_user, order_id):
-    # Simulation for testing
-    if not HERO_SMS_API_KEY:
-        import random
-        if random.random() > 0.7:
-             res = {"sms": {"code": str(random.randint(100000, 999999))}}
-        else:
-             res = "STATUS_WAIT_CODE"
-    else:
-        # Call Hero-SMS API V2
-        res = call_hero_api('getStatusV2', id=order_id)
+    seq = order_events.seq
+    with db() as conn:
+        order = conn.execute('SELECT status, sms_code, timestamp FROM orders WHERE order_id_provider = ? AND user_id = ?',
+                             (order_id, current_user['id'])).fetchone()
 
-    status = 'waiting'
-    sms_code = None
+    if not order:
+        return jsonify({'message': 'Order not found'}), 404
 
-    if isinstance(res, dict) and res.get('sms') and res['sms'].get('code'):
-        status = 'received'
-        sms_code = res['sms']['code']
-    elif res == "STATUS_WAIT_CODE":
-        status = 'waiting'
-    elif res == "STATUS_CANCEL" or (isinstance(res, dict) and res.get('title') == 'CANCELED'):
-        status = 'cancelled'
-
-    # Update local DB
-    conn = get_db_connection()
-    conn.execute('UPDATE orders SET status = ?, sms_code = ? WHERE order_id_provider = ? AND user_id = ?',
-                 (status, sms_code, order_id, current_user['id']))
-    conn.commit()
-    conn.close()
+    # The background poller or provider webhook keeps the row current, so answer from the database;
+    # a received or cancelled order is final either way
+    if order_rows_are_current(_waiting_seconds(order)) or order['status'] != 'waiting':
+        def still_waiting():
+            with db() as conn:
+                return conn.execute("SELECT 1 FROM orders WHERE order_id_provider = ? AND user_id = ? AND status = 'waiting'",
+                                    (order_id, current_user['id'])).fetchone() is not None
+        if order['status'] == 'waiting' and wait_for_order_update(order_id, _requested_wait(), seq, still_waiting):
+            with db() as conn:
+                order = conn.execute('SELECT status, sms_code FROM orders WHERE order_id_provider = ? AND user_id = ?',
+                                     (order_id, current_user['id'])).fetchone()
+        return jsonify({
+            'order_id': order_id,
+            'status': order['status'],
+            'sms_code': order['sms_code']
+        })
+
+    # Call Hero-SMS API V2
+    res = call_hero_api('getStatusV2', id=order_id)
+
+    status, sms_code = parse_status_v2(res)
+
+    with db() as conn:
+        changed = apply_provider_status(conn, order_id, status, sms_code)
+    if changed:
+        notify_order_changed(order_id)
 
     return jsonify({
         'order_id': order_id,
@@ -763,12 +2299,389 @@ def get_order_status(current_user, order_id):
         'sms_code': sms_code
     })
 
+# --- Provider webhook ---
+# HeroSMS POSTs incoming SMS to the URLs configured in the account. It doesn't sign
+# requests, so the URL carries a shared secret (?secret=...) and the documented source
+# IPs (84.32.223.53, 185.138.88.87) can optionally be enforced via PROVIDER_WEBHOOK_IPS.
+# The allowlist sees the proxy's address behind a reverse proxy unless TRUSTED_PROXY_HOPS is set.
+
+PROVIDER_WEBHOOK_SECRET = os.environ.get('PROVIDER_WEBHOOK_SECRET', '')
+PROVIDER_WEBHOOK_IPS = {ip.strip() for ip in os.environ.get('PROVIDER_WEBHOOK_IPS', '').split(',') if ip.strip()}
+# Without a fresh poller, how long a waiting order is answered from the DB alone
+PROVIDER_WEBHOOK_GRACE = int(os.environ.get('PROVIDER_WEBHOOK_GRACE', '120'))
+
+@app.route('/api/provider/webhook', methods=['POST'])
+def provider_webhook():
+    if not PROVIDER_WEBHOOK_SECRET:
+        return jsonify({'message': 'Webhook not configured'}), 404
+    if not hmac.compare_digest(request.args.get('secret', ''), PROVIDER_WEBHOOK_SECRET):
+        return jsonify({'message': 'Unauthorized'}), 403
+    if PROVIDER_WEBHOOK_IPS and request.remote_addr not in PROVIDER_WEBHOOK_IPS:
+        return jsonify({'message': 'Unauthorized'}), 403
+
+    data = request.get_json(silent=True) or {}
+    order_id = data.get('activationId')
+    sms_code = data.get('code') or data.get('text')
+    if not order_id or not sms_code:
+        return jsonify({'message': 'Missing parameters!'}), 400
+
+    # Retries of an already-applied push match no rows
+    with db() as conn:
+        changed = conn.execute(
+            "UPDATE orders SET status = 'received', sms_code = ? WHERE order_id_provider = ? AND status IN ('waiting', 'received') AND sms_code IS NOT ?",
+            (str(sms_code), str(order_id), str(sms_code))
+        ).rowcount
+    if changed:
+        notify_order_changed(order_id)
+
+    # Always 200 for authenticated pushes, otherwise the provider keeps retrying
+    return jsonify({'ok': True, 'updated': changed})
+
+# --- Server-Sent Events ---
+
+SSE_HEARTBEAT_SECONDS = 15
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', '3'))
+SSE_REPLAY_LIMIT = 50
+
+_open_streams = {}
+_open_streams_lock = threading.Lock()
+
+def _acquire_stream(key):
+    with _open_streams_lock:
+        if _open_streams.get(key, 0) >= SSE_MAX_STREAMS:
+            return False
+        _open_streams[key] = _open_streams.get(key, 0) + 1
+        return True
+
+def _release_stream(key):
+    with _open_streams_lock:
+        _open_streams[key] -= 1
+        if not _open_streams[key]:
+            del _open_streams[key]
+
+def _count_open_streams():
+    with _open_streams_lock:
+        return sum(_open_streams.values())
+
+Gauge('sse_streams_open', 'Open order event streams').set_function(_count_open_streams)
+
+def _sse(event, data, event_id=None):
+    msg = f"id: {event_id}\n" if event_id is not None else ""
+    return msg + f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def _order_payload(order):
+    return {k: v for k, v in order.items() if k != 'token'}
+
+def _last_event_id():
+    raw = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    if raw is None:
+        return None
+    try:
+        return int(raw)
+    except ValueError:
+        return -1
+
+def order_event_stream(match, load_changes, last_event_id):
+    """SSE generator for one subscriber.
+
+    Event ids are orders.change_seq, which all worker processes share, so a client that
+    reconnects to any worker with Last-Event-ID is sent exactly the rows changed since.
+    `load_changes(seq, limit)` returns the subscriber's rows with change_seq > seq in
+    change_seq order. Broker events matching `match(order)` only wake the stream early;
+    changes written by other processes are picked up on the next heartbeat.
+    """
+    def gen():
+        local = order_events.seq
+        with db() as conn:
+            cursor = orders_change_seq(conn)
+        yield "retry: 3000\n\n"
+        if last_event_id is None:
+            yield _sse('ready', {}, cursor)
+        elif last_event_id < 0 or last_event_id > cursor:
+            yield _sse('resync', {}, cursor)
+        else:
+            missed = load_changes(last_event_id, SSE_REPLAY_LIMIT + 1)
+            if len(missed) > SSE_REPLAY_LIMIT:
+                yield _sse('resync', {}, cursor)
+            else:
+                for order in missed:
+                    yield _sse('order', _order_payload(order), order['change_seq'])
+                if missed:
+                    cursor = max(cursor, missed[-1]['change_seq'])
+
+        while True:
+            latest = order_events.wait(local, SSE_HEARTBEAT_SECONDS)
+            heartbeat = latest == local
+            if not heartbeat:
+                events = order_events.since(local)
+                local = latest
+                if events is not None and not any(match(order) for _, order in events):
+                    continue
+            while True:
+                changes = load_changes(cursor, SSE_REPLAY_LIMIT)
+                for order in changes:
+                    cursor = order['change_seq']
+                    yield _sse('order', _order_payload(order), cursor)
+                if len(changes) < SSE_REPLAY_LIMIT:
+                    break
+            if heartbeat:
+                yield ": ping\n\n"
+
+    return gen()
+
+def _sse_response(stream, key):
+    response = Response(stream, mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Runs when the client disconnects, even if the stream never started
+    response.call_on_close(lambda: _release_stream(key))
+    return response
+
+# EventSource can't send headers, and a JWT in the URL ends up in access logs and browser
+# history. The dashboard instead POSTs for a short-lived, single-use ticket and opens the
+# stream with ?ticket=, fetching a new one for every reconnect.
+STREAM_TICKET_TTL = 30
+
+@app.route('/api/orders/stream-ticket', methods=['POST'])
+@token_required
+def issue_stream_ticket(current_user):
+    ticket = secrets.token_urlsafe(24)
+    now = time.time()
+    with db() as conn:
+        conn.execute('DELETE FROM stream_tickets WHERE expires_at < ?', (now,))
+        conn.execute('INSERT INTO stream_tickets (ticket, user_id, token_version, expires_at) VALUES (?, ?, ?, ?)',
+                     (ticket, current_user['id'], current_user.get('token_version') or 0, now + STREAM_TICKET_TTL))
+    return jsonify({'ticket': ticket, 'expires_in': STREAM_TICKET_TTL})
+
+def redeem_stream_ticket(ticket):
+    """Return the user a stream ticket was issued to, or None. A ticket works once."""
+    with db() as conn:
+        row = conn.execute('DELETE FROM stream_tickets WHERE ticket = ? RETURNING user_id, token_version, expires_at',
+                           (ticket,)).fetchone()
+    if not row or row['expires_at'] < time.time():
+        return None
+    return get_cached_user(row['user_id'], row['token_version'])
+
+@app.route('/api/orders/stream', methods=['GET'])
+def stream_orders():
+    ticket = request.args.get('ticket')
+    if ticket:
+        current_user = redeem_stream_ticket(ticket)
+        if not current_user:
+            return jsonify({'message': 'Stream ticket is invalid or expired!'}), 401
+    else:
+        token = None
+        if 'Authorization' in request.headers:
+            token = request.headers['Authorization'].split(" ")[1]
+        if not token:
+            return jsonify({'message': 'Token is missing!'}), 401
+        try:
+            current_user = user_from_token(token)
+        except Exception as e:
+            return jsonify({'message': 'Token is invalid!', 'error': str(e)}), 401
+        if not current_user:
+            return jsonify({'message': 'User not found!'}), 401
+
+    user_id = current_user['id']
+    key = f"user:{user_id}"
+    if not _acquire_stream(key):
+        return jsonify({'message': 'Too many open streams.'}), 429
+
+    def load_changes(seq, limit):
+        with db() as conn:
+            rows = conn.execute('SELECT * FROM orders WHERE user_id = ? AND change_seq > ? ORDER BY change_seq LIMIT ?',
+                                (user_id, seq, limit)).fetchall()
+        return [dict(r) for r in rows]
+
+    return _sse_response(order_event_stream(lambda o: o['user_id'] == user_id, load_changes, _last_event_id()), key)
+
+@app.route('/api/direct/stream', methods=['GET'])
+def direct_stream():
+    token = request.args.get('token')
+    if not token:
+        return jsonify({'message': 'Missing parameters!'}), 400
+
+    with db() as conn:
+        p_token = conn.execute('SELECT 1 FROM purchase_tokens WHERE token = ?', (token,)).fetchone()
+    if not p_token:
+        return jsonify({'message': 'Invalid or expired token!'}), 403
+
+    key = f"token:{token}"
+    if not _acquire_stream(key):
+        return jsonify({'message': 'Too many open streams.'}), 429
+
+    def load_changes(seq, limit):
+        with db() as conn:
+            rows = conn.execute('SELECT * FROM orders WHERE token = ? AND change_seq > ? ORDER BY change_seq LIMIT ?',
+                                (token, seq, limit)).fetchall()
+        return [dict(r) for r in rows]
+
+    return _sse_response(order_event_stream(lambda o: o['token'] == token, load_changes, _last_event_id()), key)
+
 # --- Telegram Bot ---
+# Updates are handled on a bounded pool of BOT_WORKERS threads. Updates from one chat run
+# one at a time and in order (next-step handlers and message edits depend on that), while
+# a slow provider call in one chat no longer blocks the rest of the admin panel.
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', '4'))
+# Transport: long polling by default, or a webhook when TELEGRAM_WEBHOOK_URL is set.
+# Only the leader process polls or registers the webhook, so several server workers
+# don't fight over getUpdates. `python server.py` leads unless BOT_LEADER=0;
+# under gunicorn and friends set BOT_LEADER=1 on exactly one process.
+TELEGRAM_WEBHOOK_URL = os.environ.get('TELEGRAM_WEBHOOK_URL', '')
+TELEGRAM_WEBHOOK_SECRET = os.environ.get('TELEGRAM_WEBHOOK_SECRET') or hashlib.sha256(
+    f"telegram-webhook:{TELEGRAM_BOT_TOKEN}".encode()).hexdigest()[:32]
+BOT_LEADER = os.environ.get('BOT_LEADER', '1' if __name__ == '__main__' else '0') == '1'
+
+BOT_MAX_PENDING = 200
+
+class ChatDispatcher:
+    """Runs handle(item) on a worker pool, serially per key."""
+
+    def __init__(self, handle, workers, max_pending):
+        self._handle = handle
+        self._lock = threading.Lock()
+        self._queues = {}  # key -> deque of items; present while the key is scheduled
+        self._ready = queue.Queue()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self.busy = 0
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f'bot-worker-{i}', daemon=True).start()
+
+    def submit(self, key, item):
+        self._slots.acquire()  # back-pressure on the poller when everything is stuck
+        with self._lock:
+            pending = self._queues.get(key)
+            if pending is not None:
+                pending.append(item)
+                return
+            self._queues[key] = deque([item])
+        self._ready.put(key)
+
+    def pending(self):
+        with self._lock:
+            return sum(len(q) for q in self._queues.values())
+
+    def _work(self):
+        while True:
+            key = self._ready.get()
+            while True:
+                with self._lock:
+                    pending = self._queues[key]
+                    if not pending:
+                        del self._queues[key]
+                        break
+                    item = pending.popleft()
+                    self.busy += 1
+                try:
+                    self._handle(item)
+                except Exception as e:
+                    print(f"Bot handler error: {e}")
+                finally:
+                    with self._lock:
+                        self.busy -= 1
+                    self._slots.release()
+
+def _update_chat_id(update):
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        cq = update.callback_query
+        return cq.message.chat.id if cq.message else cq.from_user.id
+    return ('update', update.update_id)
+
+class DispatchingTeleBot(telebot.TeleBot):
+    """TeleBot whose updates are handed to a ChatDispatcher instead of run inline."""
+
+    def __init__(self, token, workers=BOT_WORKERS):
+        super().__init__(token, threaded=False)
+        self.dispatcher = ChatDispatcher(lambda u: super(DispatchingTeleBot, self).process_new_updates([u]),
+                                         workers, BOT_MAX_PENDING)
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            # Advance the offset now; the handler may run later
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            cq = update.callback_query
+            # Routes marked slow call the provider: ack now so Telegram stops the button
+            # spinner, and let the handler report its result with notify_callback()
+            if cq and callback_router.is_slow(cq.data) and str(cq.from_user.id) == ADMIN_TELEGRAM_ID:
+                try:
+                    self.answer_callback_query(cq.id, "⏳ Working...")
+                    cq.acked = True
+                except Exception as e:
+                    print(f"Could not ack callback: {e}")
+            self.dispatcher.submit(_update_chat_id(update), update)
+
+class CallbackRouter:
+    """Maps callback_data to handlers by the longest registered prefix. callback_data is
+    '_'-separated, so prefixes live in a trie of segments and a lookup is one split plus a
+    dict step per segment, however many screens exist. The segments after the prefix are
+    converted with the route's parameter types; trailing parameters may be omitted if the
+    handler has defaults for them."""
+
+    def __init__(self):
+        self._root = {}
+
+    def route(self, prefix, *params, slow=False):
+        def register(handler):
+            node = self._root
+            for segment in prefix.rstrip('_').split('_'):
+                node = node.setdefault(segment, {})
+            node[None] = (handler, params, slow)  # None never collides with a segment
+            return handler
+        return register
+
+    def match(self, data):
+        """(handler, params, slow) and the payload segments after the prefix, or (None, None)."""
+        parts = data.split('_')
+        node, found, end = self._root, None, 0
+        for i, segment in enumerate(parts):
+            node = node.get(segment)
+            if node is None:
+                break
+            if None in node:
+                found, end = node[None], i + 1
+        if found is None:
+            return None, None
+        return found, parts[end:]
+
+    def is_slow(self, data):
+        entry, _ = self.match(data or '')
+        return bool(entry and entry[2])
+
+    def dispatch(self, call):
+        """Run the handler for call.data; False if nothing matches or the payload is malformed."""
+        entry, parts = self.match(call.data or '')
+        if entry is None:
+            return False
+        handler, params, _ = entry
+        if len(parts) > len(params):
+            return False
+        try:
+            args = [convert(part) for convert, part in zip(params, parts)]
+        except ValueError:
+            return False
+        handler(call, *args)
+        return True
+
+callback_router = CallbackRouter()
+
+# Users per page in the bot's user browser; each is one keyboard row
+USERS_PAGE_SIZE = 20
 
 if TELEGRAM_BOT_TOKEN and ":" in TELEGRAM_BOT_TOKEN:
-    bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
+    bot = DispatchingTeleBot(TELEGRAM_BOT_TOKEN)
+    Gauge('bot_workers_busy', 'Bot workers running a handler').set_function(lambda: bot.dispatcher.busy)
+    Gauge('bot_updates_pending', 'Bot updates queued behind their chat').set_function(bot.dispatcher.pending)
     from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 
+    def notify_callback(call, text):
+        """Answer a callback query, or send a message if it was already acked."""
+        if getattr(call, 'acked', False):
+            bot.send_message(call.message.chat.id, text)
+        else:
+            bot.answer_callback_query(call.id, text)
+
     COUNTRY_FLAGS = {
         'AE':'🇦🇪','AU':'🇦🇺','BR':'🇧🇷','CA':'🇨🇦','CH':'🇨🇭','CN':'🇨🇳',
         'DE':'🇩🇪','ES':'🇪🇸','FR':'🇫🇷','GB':'🇬🇧','ID':'🇮🇩','IN':'🇮🇳',
@@ -777,15 +2690,9 @@ if TELEGRAM_BOT_TOKEN and ":" in TELEGRAM_BOT_TOKEN:
         'TR':'🇹🇷','TZ':'🇹🇿','UG':'🇺🇬','US':'🇺🇸','ZA':'🇿🇦'
     }
 
-    @bot.message_handler(commands=['start', 'menu'])
-    def send_welcome(message):
-        if str(message.from_user.id) != ADMIN_TELEGRAM_ID:
-            bot.reply_to(message, "Unauthorized.")
-            return
-
-        conn = get_db_connection()
-        setting = conn.execute("SELECT value FROM settings WHERE key = 'whitelist_required'").fetchone()
-        conn.close()
+    def main_menu_screen():
+        with db() as conn:
+            setting = conn.execute("SELECT value FROM settings WHERE key = 'whitelist_required'").fetchone()
         wl_mode = setting and setting['value'] == '1'
         wl_label = '🔒 Whitelist: ON' if wl_mode else '🔓 Whitelist: OFF (open)'
 
@@ -799,359 +2706,459 @@ if TELEGRAM_BOT_TOKEN and ":" in TELEGRAM_BOT_TOKEN:
         markup.add(InlineKeyboardButton("🏷️ Check Prices", callback_data="view_prices"))
         markup.add(InlineKeyboardButton(wl_label, callback_data="toggle_whitelist"))
         markup.add(InlineKeyboardButton("🎟️ Direct Purchase Tokens", callback_data="manage_tokens"))
-        bot.send_message(message.chat.id, "SMSKenya Admin Panel:", reply_markup=markup)
+        markup.add(InlineKeyboardButton("🧹 Sweep Stale Orders", callback_data="sweep_stale"))
+        if WARM_INVENTORY:
+            markup.add(InlineKeyboardButton("🔥 Warm Inventory", callback_data="warm_stats"))
+        return "SMSKenya Admin Panel:", markup
 
-    @bot.callback_query_handler(func=lambda call: True)
-    def callback_query(call):
-        if str(call.from_user.id) != ADMIN_TELEGRAM_ID:
-            bot.answer_callback_query(call.id, "Unauthorized")
+    @bot.message_handler(commands=['start', 'menu'])
+    def send_welcome(message):
+        if str(message.from_user.id) != ADMIN_TELEGRAM_ID:
+            bot.reply_to(message, "Unauthorized.")
+            return
+
+        text, markup = main_menu_screen()
+        bot.send_message(message.chat.id, text, reply_markup=markup)
+
+    @bot.message_handler(commands=['find'])
+    def find_user(message):
+        if str(message.from_user.id) != ADMIN_TELEGRAM_ID:
+            bot.reply_to(message, "Unauthorized.")
+            return
+
+        parts = message.text.split(maxsplit=1)
+        if len(parts) < 2:
+            bot.reply_to(message, "❌ Format: `/find <username prefix>`", parse_mode="Markdown")
             return
+        text, markup = find_users_screen(parts[1].strip())
+        bot.send_message(message.chat.id, text, reply_markup=markup)
+
+    # --- Screens: each returns (text, markup) and can be shown from any handler ---
+
+    def show(call, screen):
+        text, markup = screen
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+
+    def warm_screen():
+        with db() as conn:
+            stock = {(r['service_id'], r['country_id']): r['n'] for r in conn.execute(
+                'SELECT service_id, country_id, COUNT(*) AS n FROM warm_numbers GROUP BY service_id, country_id')}
+        with _warm_stats_lock:
+            stats = dict(warm_stats)
+        served = stats['hits'] + stats['misses']
+        hit_rate = f"{100 * stats['hits'] / served:.0f}%" if served else "n/a"
+        text = "🔥 Warm inventory (this process)\n\n"
+        for (service_id, country_id), target in WARM_INVENTORY.items():
+            text += f"• {service_id}@{country_id}: {stock.get((service_id, country_id), 0)}/{target} ready\n"
+        text += (f"\nHit rate: {hit_rate} ({stats['hits']} hits, {stats['misses']} misses)\n"
+                 f"Bought: {stats['acquired']} | Cancelled unused: {stats['cancelled']}\n"
+                 f"Failed cancels: {stats['cancel_failed']} (${stats['wasted_spend']:.2f} wasted)")
+        markup = InlineKeyboardMarkup()
+        markup.add(InlineKeyboardButton("🔄 Refresh", callback_data="warm_stats"))
+        markup.add(InlineKeyboardButton("« Back", callback_data="main_menu"))
+        return text, markup
+
+    def user_summaries(conn, users):
+        """Quota and active-order counts for a page of users, in one aggregated query."""
+        ids = [u['id'] for u in users]
+        if not ids:
+            return {}
+        rows = conn.execute(f"""
+            SELECT u.id, COALESCE(q.used_numbers, 0) AS used, COALESCE(q.allowed_numbers, 0) AS allowed,
+                   COUNT(o.id) AS active
+            FROM users u
+            LEFT JOIN quotas q ON q.user_id = u.id
+            LEFT JOIN orders o ON o.user_id = u.id AND o.status IN ('waiting', 'received')
+            WHERE u.id IN ({",".join("?" * len(ids))})
+            GROUP BY u.id
+        """, ids).fetchall()
+        return {r['id']: r for r in rows}
+
+    def user_buttons(markup, users, summaries):
+        text = ""
+        for user in users:
+            s = summaries[user['id']]
+            line = f"{user['username']} · {s['used']}/{s['allowed']} · {s['active']} active"
+            text += f"• {line}\n"
+            markup.add(InlineKeyboardButton(line, callback_data=f"user_{user['id']}"))
+        return text
+
+    def users_screen(after_id=0, before_id=None):
+        """One keyset page of users by id: after after_id, or the page ending before before_id."""
+        with db() as conn:
+            if before_id is not None:
+                users = conn.execute('SELECT id, username FROM users WHERE id < ? ORDER BY id DESC LIMIT ?',
+                                     (before_id, USERS_PAGE_SIZE + 1)).fetchall()[::-1]
+                has_prev = len(users) > USERS_PAGE_SIZE
+                users = users[-USERS_PAGE_SIZE:] if has_prev else users
+                has_next = True
+            else:
+                users = conn.execute('SELECT id, username FROM users WHERE id > ? ORDER BY id LIMIT ?',
+                                     (after_id, USERS_PAGE_SIZE + 1)).fetchall()
+                has_next = len(users) > USERS_PAGE_SIZE
+                users = users[:USERS_PAGE_SIZE]
+                has_prev = after_id > 0
+            summaries = user_summaries(conn, users)
+
+        markup = InlineKeyboardMarkup()
+        text = "Select a user (used/allowed · active orders):\n\n" + user_buttons(markup, users, summaries)
+        if not users:
+            text = "No users."
+        nav = []
+        if has_prev and users:
+            nav.append(InlineKeyboardButton("« Prev", callback_data=f"list_users_before_{users[0]['id']}"))
+        if has_next and users:
+            nav.append(InlineKeyboardButton("Next »", callback_data=f"list_users_{users[-1]['id']}"))
+        if nav:
+            markup.add(*nav)
+        markup.add(InlineKeyboardButton("« Back", callback_data="main_menu"))
+        return text + "\nSearch by name with /find <prefix>", markup
+
+    def find_users_screen(prefix):
+        pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        with db() as conn:
+            users = conn.execute(
+                "SELECT id, username FROM users WHERE username LIKE ? ESCAPE '\\' ORDER BY username COLLATE NOCASE LIMIT ?",
+                (pattern, USERS_PAGE_SIZE + 1)
+            ).fetchall()
+            summaries = user_summaries(conn, users[:USERS_PAGE_SIZE])
+
+        markup = InlineKeyboardMarkup()
+        if not users:
+            text = f"No users starting with '{prefix}'."
+        else:
+            text = f"Users starting with '{prefix}':\n\n" + user_buttons(markup, users[:USERS_PAGE_SIZE], summaries)
+            if len(users) > USERS_PAGE_SIZE:
+                text += f"\nShowing the first {USERS_PAGE_SIZE}; type more of the name to narrow it down."
+        markup.add(InlineKeyboardButton("👥 All Users", callback_data="list_users"))
+        return text, markup
+
+    def user_screen(user_id):
+        """None if the user doesn't exist."""
+        with db() as conn:
+            user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+            if not user:
+                return None
+            # Auto-create missing quota row
+            conn.execute('INSERT OR IGNORE INTO quotas (user_id, allowed_numbers, used_numbers) VALUES (?, 0, 0)', (user_id,))
+            quota = conn.execute('SELECT * FROM quotas WHERE user_id = ?', (user_id,)).fetchone()
 
-        if call.data == "check_balance":
-            res = call_hero_api('getBalance')
-            bot.answer_callback_query(call.id, f"Balance: {res}")
-            # Refresh menu to show balance in text maybe? Or just alert.
-
-        elif call.data == "list_users":
-            conn = get_db_connection()
-            users = conn.execute('SELECT id, username FROM users').fetchall()
-            conn.close()
-
-            markup = InlineKeyboardMarkup()
-            for user in users:
-                markup.add(InlineKeyboardButton(user['username'], callback_data=f"user_{user['id']}"))
-            markup.add(InlineKeyboardButton("« Back", callback_data="main_menu"))
-            bot.edit_message_text("Select a user:", call.message.chat.id, call.message.message_id, reply_markup=markup)
-
-        elif call.data.startswith("user_orders_"):
-            user_id = call.data.split("_")[2]
-            conn = get_db_connection()
+        text = f"👤 User: {user['username']}\n📊 Quota: {quota['used_numbers']} used / {quota['allowed_numbers']} allowed"
+        markup = InlineKeyboardMarkup()
+        markup.add(InlineKeyboardButton("⚙️ Set Quota (replace)", callback_data=f"askquota_{user_id}"))
+        markup.add(InlineKeyboardButton("➕ Add to Quota", callback_data=f"askquota_add_{user_id}"))
+        markup.add(InlineKeyboardButton("📋 View Active Orders", callback_data=f"user_orders_{user_id}"))
+        markup.add(InlineKeyboardButton("🛡️ Manage Whitelist", callback_data=f"whitelist_{user_id}"))
+        markup.add(InlineKeyboardButton("🚪 Log Out All Sessions", callback_data=f"kick_{user_id}"))
+        markup.add(InlineKeyboardButton("« Back to Users", callback_data="list_users"))
+        return text, markup
+
+    def user_orders_screen(user_id):
+        with db() as conn:
             orders = conn.execute(
                 "SELECT * FROM orders WHERE user_id = ? AND status IN ('waiting','received') ORDER BY timestamp DESC LIMIT 10",
                 (user_id,)
             ).fetchall()
-            conn.close()
-            markup = InlineKeyboardMarkup()
-            if not orders:
-                text = f"No active orders for user {user_id}."
-            else:
-                text = f"📋 Active orders (user {user_id}):\n\n"
-                for o in orders:
-                    text += f"• #{o['order_id_provider']} | {o['service_id']}@{o['country_id']} | {o['status']}\n  {o['phone_number']}\n\n"
-                    markup.add(
-                        InlineKeyboardButton(f"❌ Cancel #{o['order_id_provider'][:6]}", callback_data=f"adm_cancel_{o['order_id_provider']}_{user_id}"),
-                        InlineKeyboardButton(f"🔄 Regen #{o['order_id_provider'][:6]}", callback_data=f"adm_regen_{o['order_id_provider']}_{user_id}_{o['service_id']}_{o['country_id']}")
-                    )
-            markup.add(InlineKeyboardButton("« Back to User", callback_data=f"user_{user_id}"))
-            bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+        markup = InlineKeyboardMarkup()
+        if not orders:
+            text = f"No active orders for user {user_id}."
+        else:
+            text = f"📋 Active orders (user {user_id}):\n\n"
+            for o in orders:
+                text += f"• #{o['order_id_provider']} | {o['service_id']}@{o['country_id']} | {o['status']}\n  {o['phone_number']}\n\n"
+                markup.add(
+                    InlineKeyboardButton(f"❌ Cancel #{o['order_id_provider'][:6]}", callback_data=f"adm_cancel_{o['order_id_provider']}_{user_id}"),
+                    InlineKeyboardButton(f"🔄 Regen #{o['order_id_provider'][:6]}", callback_data=f"adm_regen_{o['order_id_provider']}_{user_id}_{o['service_id']}_{o['country_id']}")
+                )
+        markup.add(InlineKeyboardButton("« Back to User", callback_data=f"user_{user_id}"))
+        return text, markup
 
-        elif call.data.startswith("user_"):
-            user_id = call.data.split("_")[1]
-            conn = get_db_connection()
-            user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-            quota = conn.execute('SELECT * FROM quotas WHERE user_id = ?', (user_id,)).fetchone()
+    def whitelist_screen(user_id, page=0):
+        per_page = 5
+        with db() as conn:
+            whitelist = conn.execute('SELECT * FROM user_whitelist WHERE user_id = ? LIMIT ? OFFSET ?',
+                                   (user_id, per_page, page * per_page)).fetchall()
+            total = conn.execute('SELECT COUNT(*) FROM user_whitelist WHERE user_id = ?', (user_id,)).fetchone()[0]
 
-            if user and not quota:
-                # Auto-create missing quota row
-                conn.execute('INSERT INTO quotas (user_id, allowed_numbers, used_numbers) VALUES (?, 0, 0)', (user_id,))
-                conn.commit()
-                quota = conn.execute('SELECT * FROM quotas WHERE user_id = ?', (user_id,)).fetchone()
+        text = f"🛡️ Whitelist for User ID {user_id} (Page {page+1}):\n"
+        markup = InlineKeyboardMarkup()
+        for entry in whitelist:
+            markup.add(InlineKeyboardButton(f"❌ Remove {entry['service_id']}@{entry['country_id']}",
+                                           callback_data=f"rmwl_{entry['id']}_{page}"))
+
+        nav_buttons = []
+        if page > 0:
+            nav_buttons.append(InlineKeyboardButton("« Prev", callback_data=f"whitelist_{user_id}_{page-1}"))
+        if (page + 1) * per_page < total:
+            nav_buttons.append(InlineKeyboardButton("Next »", callback_data=f"whitelist_{user_id}_{page+1}"))
+        if nav_buttons:
+            markup.add(*nav_buttons)
+
+        markup.add(InlineKeyboardButton("➕ Add New Pair", callback_data=f"addwl_{user_id}"))
+        markup.add(InlineKeyboardButton("« Back to User", callback_data=f"user_{user_id}"))
+        return text, markup
+
+    def tokens_screen():
+        markup = InlineKeyboardMarkup()
+        markup.add(InlineKeyboardButton("Generate New Token", callback_data="gen_token"))
+        markup.add(InlineKeyboardButton("« Back", callback_data="main_menu"))
+        return "Manage Direct Purchase Tokens:", markup
+
+    def mappings_screen(mapping_type, page=0):
+        per_page = 10
+        with db() as conn:
+            rows = conn.execute(
+                "SELECT frontend_id, provider_id FROM mappings WHERE type = ? ORDER BY frontend_id LIMIT ? OFFSET ?",
+                (mapping_type, per_page, page * per_page)
+            ).fetchall()
+            total = conn.execute("SELECT COUNT(*) FROM mappings WHERE type = ?", (mapping_type,)).fetchone()[0]
+        if mapping_type == 'service':
+            prefix = "list_services"
+            text = "📋 Service Mappings:\n\n" + "\n".join(f"  {r['frontend_id']} → {r['provider_id']}" for r in rows)
+        else:
+            prefix = "list_countries"
+            text = "🌍 Country Mappings:\n\n" + "\n".join(
+                f"  {COUNTRY_FLAGS.get(r['frontend_id'],'')} {r['frontend_id']} → {r['provider_id']}" for r in rows)
+        markup = InlineKeyboardMarkup()
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("« Prev", callback_data=f"{prefix}_{page-1}"))
+        if (page + 1) * per_page < total:
+            nav.append(InlineKeyboardButton("Next »", callback_data=f"{prefix}_{page+1}"))
+        if nav:
+            markup.add(*nav)
+        markup.add(InlineKeyboardButton("« Back", callback_data="main_menu"))
+        return text, markup
+
+    def price_services_screen():
+        markup = InlineKeyboardMarkup()
+        svcs = ['wa', 'tg', 'ig', 'fb', 'goo', 'tt', 'pp', 'go']
+        row = []
+        for svc in svcs:
+            row.append(InlineKeyboardButton(svc.upper(), callback_data=f"price_svc_{svc}"))
+            if len(row) == 4:
+                markup.add(*row)
+                row = []
+        if row:
+            markup.add(*row)
+        markup.add(InlineKeyboardButton("« Back", callback_data="main_menu"))
+        return "Select service:", markup
+
+    def price_countries_screen(svc):
+        with db() as conn:
+            countries = conn.execute("SELECT frontend_id, provider_id FROM mappings WHERE type='country' ORDER BY frontend_id").fetchall()
+        markup = InlineKeyboardMarkup()
+        row = []
+        for c in countries:
+            flag = COUNTRY_FLAGS.get(c['frontend_id'], '')
+            row.append(InlineKeyboardButton(f"{flag}{c['frontend_id']}", callback_data=f"pchk_{svc}_{c['frontend_id']}_{c['provider_id']}"))
+            if len(row) == 3:
+                markup.add(*row)
+                row = []
+        if row:
+            markup.add(*row)
+        markup.add(InlineKeyboardButton("« Back", callback_data="view_prices"))
+        return f"Select country for {svc.upper()}:", markup
+
+    def price_check_screen(svc, fe_country, prov_country):
+        res = get_price_matrix()
+        if isinstance(res, dict) and str(prov_country) in res:
+            sd = res[str(prov_country)].get(svc, {})
+            cost = sd.get('cost', 'N/A')
+            count = sd.get('count', 'N/A')
+            age = int(price_matrix_cache.age() or 0)
+            text = f"🏷️ {svc.upper()} @ {fe_country} (ID:{prov_country})\n💰 Cost: ${cost}\n📦 Stock: {count}\n🕒 {age}s ago"
+        else:
+            text = f"No data for {svc}@{prov_country}.\nRaw: {str(res)[:300]}"
+        markup = InlineKeyboardMarkup()
+        markup.add(InlineKeyboardButton("« Back to Countries", callback_data=f"price_svc_{svc}"))
+        markup.add(InlineKeyboardButton("« Main Menu", callback_data="main_menu"))
+        return text, markup
 
-            conn.close()
+    # --- Callback routes ---
 
-            if not user:
-                bot.answer_callback_query(call.id, "❌ User not found.")
-                return
+    @bot.callback_query_handler(func=lambda call: True)
+    def callback_query(call):
+        if str(call.from_user.id) != ADMIN_TELEGRAM_ID:
+            bot.answer_callback_query(call.id, "Unauthorized")
+            return
+        if not callback_router.dispatch(call):
+            bot.answer_callback_query(call.id, "This button is no longer valid.")
+
+    @callback_router.route("main_menu")
+    def on_main_menu(call):
+        show(call, main_menu_screen())
+
+    @callback_router.route("check_balance", slow=True)
+    def on_check_balance(call):
+        res = call_hero_api('getBalance')
+        notify_callback(call, f"Balance: {res}")
+
+    @callback_router.route("sweep_stale", slow=True)
+    def on_sweep_stale(call):
+        summary = sweep_stale_orders()
+        if summary is None:
+            notify_callback(call, "A sweep is already running.")
+            return
+        text = (f"🧹 Waiting orders older than {STALE_ORDER_AGE // 60} min: {summary['found']}\n"
+                f"Cancelled: {summary['cancelled']} | Already over: {summary['gone']} | Code received: {summary['received']} | Quota refunded: {summary['refunded']}")
+        for reason, count in summary['failed'].items():
+            text += f"\n❌ {reason}: {count}"
+        notify_callback(call, text)
+
+    @callback_router.route("warm_stats")
+    def on_warm_stats(call):
+        show(call, warm_screen())
+
+    @callback_router.route("list_users", int)
+    def on_list_users(call, after_id=0):
+        show(call, users_screen(after_id))
+
+    @callback_router.route("list_users_before", int)
+    def on_list_users_before(call, before_id):
+        show(call, users_screen(before_id=before_id))
+
+    @callback_router.route("user_", int)
+    def on_user(call, user_id):
+        screen = user_screen(user_id)
+        if not screen:
+            bot.answer_callback_query(call.id, "❌ User not found.")
+            return
+        show(call, screen)
 
-            text = f"👤 User: {user['username']}\n📊 Quota: {quota['used_numbers']} used / {quota['allowed_numbers']} allowed"
-            markup = InlineKeyboardMarkup()
-            markup.add(InlineKeyboardButton("⚙️ Set Quota (replace)", callback_data=f"askquota_{user_id}"))
-            markup.add(InlineKeyboardButton("➕ Add to Quota", callback_data=f"askquota_add_{user_id}"))
-            markup.add(InlineKeyboardButton("📋 View Active Orders", callback_data=f"user_orders_{user_id}"))
-            markup.add(InlineKeyboardButton("🛡️ Manage Whitelist", callback_data=f"whitelist_{user_id}"))
-            markup.add(InlineKeyboardButton("« Back to Users", callback_data="list_users"))
-            bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
-
-        elif call.data.startswith("adm_cancel_"):
-            parts = call.data.split("_")
-            order_id = parts[2]
-            user_id = parts[3]
-            conn = get_db_connection()
-            order = conn.execute('SELECT * FROM orders WHERE order_id_provider = ?', (order_id,)).fetchone()
-            res = call_hero_api('cancelActivation', id=order_id) if HERO_SMS_API_KEY else "ACCESS_CANCEL"
-            if res == "ACCESS_CANCEL" or (isinstance(res, dict) and res.get('status') == 'SUCCESS'):
-                cursor = conn.cursor()
-                cursor.execute('UPDATE orders SET status = ? WHERE order_id_provider = ?', ('cancelled', order_id))
-                if order and order['status'] == 'waiting' and order['user_id']:
-                    cursor.execute('UPDATE quotas SET used_numbers = used_numbers - 1 WHERE user_id = ?', (order['user_id'],))
-                conn.commit()
-                bot.answer_callback_query(call.id, f"✅ Order {order_id[:8]} cancelled.")
-            else:
-                bot.answer_callback_query(call.id, f"❌ Failed: {str(res)[:80]}")
-            conn.close()
-            # Navigate back to orders list
-            class Obj: pass
-            new_call = Obj()
-            new_call.data = f"user_orders_{user_id}"
-            new_call.from_user = call.from_user
-            new_call.message = call.message
-            new_call.id = call.id
-            callback_query(new_call)
-
-        elif call.data.startswith("adm_regen_"):
-            parts = call.data.split("_")
-            old_order_id = parts[2]
-            user_id = parts[3]
-            service_id = parts[4]
-            country_id = parts[5]
-            # Cancel old
-            if HERO_SMS_API_KEY:
-                call_hero_api('cancelActivation', id=old_order_id)
-            conn = get_db_connection()
+    @callback_router.route("user_orders_", int)
+    def on_user_orders(call, user_id):
+        show(call, user_orders_screen(user_id))
+
+    @callback_router.route("kick_", int)
+    def on_kick(call, user_id):
+        revoke_user_sessions(user_id)
+        bot.answer_callback_query(call.id, "✅ All sessions logged out. The user must log in again.")
+
+    @callback_router.route("adm_cancel_", str, int, slow=True)
+    def on_admin_cancel(call, order_id, user_id):
+        res = call_hero_api('cancelActivation', id=order_id)
+        if cancel_accepted(res):
+            with db() as conn:
+                cancel_order_row(conn, order_id)
+            notify_order_changed(order_id)
+            notify_callback(call, f"✅ Order {order_id[:8]} cancelled.")
+        else:
+            notify_callback(call, f"❌ Failed: {str(res)[:80]}")
+        show(call, user_orders_screen(user_id))
+
+    @callback_router.route("adm_regen_", str, int, str, str, slow=True)
+    def on_admin_regen(call, old_order_id, user_id, service_id, country_id):
+        # Cancel old
+        call_hero_api('cancelActivation', id=old_order_id)
+        with db() as conn:
             conn.execute('UPDATE orders SET status = ? WHERE order_id_provider = ?', ('cancelled', old_order_id))
-            conn.commit()
-            conn.close()
-            # Get new
-            p_service = get_mapping(service_id, 'service')
-            p_country = get_mapping(country_id, 'country')
-            if HERO_SMS_API_KEY:
-                res = get_number_with_smart_pricing(p_service, p_country)
-            else:
-                import random
-                res = {"activationId": str(random.randint(100000,999999)), "phoneNumber": f"1{random.randint(2000000000,9999999999)}"}
-            if isinstance(res, dict) and 'activationId' in res:
-                conn = get_db_connection()
-                conn.execute(
-                    'INSERT INTO orders (user_id, service_id, country_id, phone_number, order_id_provider, status) VALUES (?,?,?,?,?,?)',
-                    (user_id, service_id, country_id, res['phoneNumber'], res['activationId'], 'waiting')
-                )
-                conn.commit()
-                conn.close()
-                bot.answer_callback_query(call.id, f"✅ New: {res['phoneNumber']}")
+        notify_order_changed(old_order_id)
+        # Get new
+        p_service = get_mapping(service_id, 'service')
+        p_country = get_mapping(country_id, 'country')
+        res = get_number_with_smart_pricing(p_service, p_country)
+        if isinstance(res, dict) and 'activationId' in res:
+            try:
+                with db() as conn:
+                    conn.execute(
+                        'INSERT INTO orders (user_id, service_id, country_id, phone_number, order_id_provider, status) VALUES (?,?,?,?,?,?)',
+                        (user_id, service_id, country_id, res['phoneNumber'], res['activationId'], 'waiting')
+                    )
+            except sqlite3.Error as e:
+                abandon_activation(res['activationId'], e)
+                notify_callback(call, "❌ Could not record the new number; it was released.")
             else:
-                bot.answer_callback_query(call.id, f"❌ No number: {str(res)[:100]}")
-            # Navigate back to orders list
-            class Obj: pass
-            new_call = Obj()
-            new_call.data = f"user_orders_{user_id}"
-            new_call.from_user = call.from_user
-            new_call.message = call.message
-            new_call.id = call.id
-            callback_query(new_call)
-
-        elif call.data.startswith("askquota_add_"):
-            user_id = call.data.split("_")[2]
-            msg = bot.send_message(call.message.chat.id, "How many numbers to ADD to this user's quota?")
-            bot.register_next_step_handler(msg, process_add_quota, user_id)
-
-        elif call.data.startswith("askquota_"):
-            user_id = call.data.split("_")[1]
-            msg = bot.send_message(call.message.chat.id, "Enter the TOTAL number of allowed generations for this user:")
-            bot.register_next_step_handler(msg, process_set_quota, user_id)
-
-        elif call.data.startswith("whitelist_"):
-            user_id = int(call.data.split("_")[1])
-            page = int(call.data.split("_")[2]) if len(call.data.split("_")) > 2 else 0
-            per_page = 5
-
-            conn = get_db_connection()
-            whitelist = conn.execute('SELECT * FROM user_whitelist WHERE user_id = ? LIMIT ? OFFSET ?',
-                                   (user_id, per_page, page * per_page)).fetchall()
-            total = conn.execute('SELECT COUNT(*) FROM user_whitelist WHERE user_id = ?', (user_id,)).fetchone()[0]
-            conn.close()
-
-            text = f"🛡️ Whitelist for User ID {user_id} (Page {page+1}):\n"
-            markup = InlineKeyboardMarkup()
-            for entry in whitelist:
-                markup.add(InlineKeyboardButton(f"❌ Remove {entry['service_id']}@{entry['country_id']}",
-                                               callback_data=f"rmwl_{entry['id']}_{page}"))
-
-            nav_buttons = []
-            if page > 0:
-                nav_buttons.append(InlineKeyboardButton("« Prev", callback_data=f"whitelist_{user_id}_{page-1}"))
-            if (page + 1) * per_page < total:
-                nav_buttons.append(InlineKeyboardButton("Next »", callback_data=f"whitelist_{user_id}_{page+1}"))
-            if nav_buttons:
-                markup.add(*nav_buttons)
-
-            markup.add(InlineKeyboardButton("➕ Add New Pair", callback_data=f"addwl_{user_id}"))
-            markup.add(InlineKeyboardButton("« Back to User", callback_data=f"user_{user_id}"))
-            bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
-
-        elif call.data.startswith("addwl_"):
-            # Instead of asking for text, let's offer buttons for common services/countries or ask for text if preferred
-            # For brevity and flexibility, let's stick to text but improve the prompt
-            user_id = call.data.split("_")[1]
-            msg = bot.send_message(call.message.chat.id, "Send service and country ID (frontend IDs) separated by space (e.g., `wa KE` or `tg US`).\n\nCommon Services: `wa`, `tg`, `ig`, `fb`, `goo`, `tt`, `pp`.\nCommon Countries: `KE`, `US`, `GB`, `CA`, `DE`.", parse_mode="Markdown")
-            bot.register_next_step_handler(msg, process_add_whitelist, user_id)
-
-        elif call.data.startswith("rmwl_"):
-            wl_id = call.data.split("_")[1]
-            page = call.data.split("_")[2] if len(call.data.split("_")) > 2 else 0
-            conn = get_db_connection()
+                notify_order_changed(res['activationId'])
+                notify_callback(call, f"✅ New: {res['phoneNumber']}")
+        else:
+            notify_callback(call, f"❌ No number: {str(res)[:100]}")
+        show(call, user_orders_screen(user_id))
+
+    @callback_router.route("askquota_add_", int)
+    def on_ask_add_quota(call, user_id):
+        msg = bot.send_message(call.message.chat.id, "How many numbers to ADD to this user's quota?")
+        bot.register_next_step_handler(msg, process_add_quota, user_id)
+
+    @callback_router.route("askquota_", int)
+    def on_ask_set_quota(call, user_id):
+        msg = bot.send_message(call.message.chat.id, "Enter the TOTAL number of allowed generations for this user:")
+        bot.register_next_step_handler(msg, process_set_quota, user_id)
+
+    @callback_router.route("whitelist_", int, int)
+    def on_whitelist(call, user_id, page=0):
+        show(call, whitelist_screen(user_id, page))
+
+    @callback_router.route("addwl_", int)
+    def on_add_whitelist(call, user_id):
+        msg = bot.send_message(call.message.chat.id, "Send service and country ID (frontend IDs) separated by space (e.g., `wa KE` or `tg US`).\n\nCommon Services: `wa`, `tg`, `ig`, `fb`, `goo`, `tt`, `pp`.\nCommon Countries: `KE`, `US`, `GB`, `CA`, `DE`.", parse_mode="Markdown")
+        bot.register_next_step_handler(msg, process_add_whitelist, user_id)
+
+    @callback_router.route("rmwl_", int, int)
+    def on_remove_whitelist(call, wl_id, page=0):
+        with db() as conn:
             row = conn.execute('SELECT user_id FROM user_whitelist WHERE id = ?', (wl_id,)).fetchone()
-            user_id = row['user_id']
             conn.execute('DELETE FROM user_whitelist WHERE id = ?', (wl_id,))
-            conn.commit()
-            conn.close()
-            bot.answer_callback_query(call.id, "✅ Removed from whitelist")
-            # Stay on the same page
-            callback_query(type('obj', (object,), {'data': f'whitelist_{user_id}_{page}', 'from_user': call.from_user, 'message': call.message, 'id': call.id}))
-
-        elif call.data == "manage_tokens":
-            markup = InlineKeyboardMarkup()
-            markup.add(InlineKeyboardButton("Generate New Token", callback_data="gen_token"))
-            markup.add(InlineKeyboardButton("« Back", callback_data="main_menu"))
-            bot.edit_message_text("Manage Direct Purchase Tokens:", call.message.chat.id, call.message.message_id, reply_markup=markup)
-
-        elif call.data == "gen_token":
-            import secrets
-            token = secrets.token_urlsafe(16)
-            conn = get_db_connection()
+        if not row:
+            bot.answer_callback_query(call.id, "Already removed.")
+            return
+        bot.answer_callback_query(call.id, "✅ Removed from whitelist")
+        # Stay on the same page
+        show(call, whitelist_screen(row['user_id'], page))
+
+    @callback_router.route("manage_tokens")
+    def on_manage_tokens(call):
+        show(call, tokens_screen())
+
+    @callback_router.route("gen_token")
+    def on_generate_token(call):
+        import secrets
+        token = secrets.token_urlsafe(16)
+        with db() as conn:
             conn.execute('INSERT INTO purchase_tokens (token) VALUES (?)', (token,))
-            conn.commit()
-            conn.close()
-            bot.send_message(call.message.chat.id, f"Generated Token:\n`{token}`", parse_mode="Markdown")
-            bot.answer_callback_query(call.id, "Token Generated")
+        bot.send_message(call.message.chat.id, f"Generated Token:\n`{token}`", parse_mode="Markdown")
+        bot.answer_callback_query(call.id, "Token Generated")
 
-        elif call.data == "main_menu":
-            conn = get_db_connection()
-            setting = conn.execute("SELECT value FROM settings WHERE key = 'whitelist_required'").fetchone()
-            conn.close()
-            wl_mode = setting and setting['value'] == '1'
-            wl_label = '🔒 Whitelist: ON' if wl_mode else '🔓 Whitelist: OFF (open)'
-
-            markup = InlineKeyboardMarkup()
-            markup.add(InlineKeyboardButton("👥 Manage Users", callback_data="list_users"))
-            markup.add(
-                InlineKeyboardButton("📋 List Services", callback_data="list_services_0"),
-                InlineKeyboardButton("🌍 List Countries", callback_data="list_countries_0")
-            )
-            markup.add(InlineKeyboardButton("💰 HeroSMS Balance", callback_data="check_balance"))
-            markup.add(InlineKeyboardButton("🏷️ Check Prices", callback_data="view_prices"))
-            markup.add(InlineKeyboardButton(wl_label, callback_data="toggle_whitelist"))
-            markup.add(InlineKeyboardButton("🎟️ Direct Purchase Tokens", callback_data="manage_tokens"))
-            bot.edit_message_text("SMSKenya Admin Panel:", call.message.chat.id, call.message.message_id, reply_markup=markup)
-
-        elif call.data.startswith("list_services_"):
-            page = int(call.data.split("_")[2])
-            per_page = 10
-            conn = get_db_connection()
-            services = conn.execute(
-                "SELECT frontend_id, provider_id FROM mappings WHERE type='service' ORDER BY frontend_id LIMIT ? OFFSET ?",
-                (per_page, page * per_page)
-            ).fetchall()
-            total = conn.execute("SELECT COUNT(*) FROM mappings WHERE type='service'").fetchone()[0]
-            conn.close()
-            lines = [f"  {s['frontend_id']} → {s['provider_id']}" for s in services]
-            text = "📋 Service Mappings:\n\n" + "\n".join(lines)
-            markup = InlineKeyboardMarkup()
-            nav = []
-            if page > 0:
-                nav.append(InlineKeyboardButton("« Prev", callback_data=f"list_services_{page-1}"))
-            if (page + 1) * per_page < total:
-                nav.append(InlineKeyboardButton("Next »", callback_data=f"list_services_{page+1}"))
-            if nav:
-                markup.add(*nav)
-            markup.add(InlineKeyboardButton("« Back", callback_data="main_menu"))
-            bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
-
-        elif call.data.startswith("list_countries_"):
-            page = int(call.data.split("_")[2])
-            per_page = 10
-            conn = get_db_connection()
-            countries = conn.execute(
-                "SELECT frontend_id, provider_id FROM mappings WHERE type='country' ORDER BY frontend_id LIMIT ? OFFSET ?",
-                (per_page, page * per_page)
-            ).fetchall()
-            total = conn.execute("SELECT COUNT(*) FROM mappings WHERE type='country'").fetchone()[0]
-            conn.close()
-            lines = [f"  {COUNTRY_FLAGS.get(c['frontend_id'],'')} {c['frontend_id']} → {c['provider_id']}" for c in countries]
-            text = "🌍 Country Mappings:\n\n" + "\n".join(lines)
-            markup = InlineKeyboardMarkup()
-            nav = []
-            if page > 0:
-                nav.append(InlineKeyboardButton("« Prev", callback_data=f"list_countries_{page-1}"))
-            if (page + 1) * per_page < total:
-                nav.append(InlineKeyboardButton("Next »", callback_data=f"list_countries_{page+1}"))
-            if nav:
-                markup.add(*nav)
-            markup.add(InlineKeyboardButton("« Back", callback_data="main_menu"))
-            bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
-
-        elif call.data == "toggle_whitelist":
-            conn = get_db_connection()
+    @callback_router.route("list_services_", int)
+    def on_list_services(call, page=0):
+        show(call, mappings_screen('service', page))
+
+    @callback_router.route("list_countries_", int)
+    def on_list_countries(call, page=0):
+        show(call, mappings_screen('country', page))
+
+    @callback_router.route("toggle_whitelist")
+    def on_toggle_whitelist(call):
+        with db() as conn:
             setting = conn.execute("SELECT value FROM settings WHERE key = 'whitelist_required'").fetchone()
             new_val = '0' if (setting and setting['value'] == '1') else '1'
             conn.execute("UPDATE settings SET value = ? WHERE key = 'whitelist_required'", (new_val,))
-            conn.commit()
-            conn.close()
-            state = 'ENABLED (restricted)' if new_val == '1' else 'DISABLED (open to all)'
-            bot.answer_callback_query(call.id, f'Whitelist mode: {state}')
-            # Refresh menu
-            callback_query(type('obj', (object,), {'data': 'main_menu', 'from_user': call.from_user, 'message': call.message, 'id': call.id}))
-
-        elif call.data == "view_prices":
-            markup = InlineKeyboardMarkup()
-            svcs = ['wa', 'tg', 'ig', 'fb', 'goo', 'tt', 'pp', 'go']
-            row = []
-            for svc in svcs:
-                row.append(InlineKeyboardButton(svc.upper(), callback_data=f"price_svc_{svc}"))
-                if len(row) == 4:
-                    markup.add(*row)
-                    row = []
-            if row:
-                markup.add(*row)
-            markup.add(InlineKeyboardButton("« Back", callback_data="main_menu"))
-            bot.edit_message_text("Select service:", call.message.chat.id, call.message.message_id, reply_markup=markup)
+        state = 'ENABLED (restricted)' if new_val == '1' else 'DISABLED (open to all)'
+        bot.answer_callback_query(call.id, f'Whitelist mode: {state}')
+        # Refresh menu
+        show(call, main_menu_screen())
 
-        elif call.data.startswith("price_svc_"):
-            svc = call.data.split("_")[2]
-            conn = get_db_connection()
-            countries = conn.execute("SELECT frontend_id, provider_id FROM mappings WHERE type='country' ORDER BY frontend_id").fetchall()
-            conn.close()
-            markup = InlineKeyboardMarkup()
-            row = []
-            for c in countries:
-                flag = COUNTRY_FLAGS.get(c['frontend_id'], '')
-                row.append(InlineKeyboardButton(f"{flag}{c['frontend_id']}", callback_data=f"pchk_{svc}_{c['frontend_id']}_{c['provider_id']}"))
-                if len(row) == 3:
-                    markup.add(*row)
-                    row = []
-            if row:
-                markup.add(*row)
-            markup.add(InlineKeyboardButton("« Back", callback_data="view_prices"))
-            bot.edit_message_text(f"Select country for {svc.upper()}:", call.message.chat.id, call.message.message_id, reply_markup=markup)
-
-        elif call.data.startswith("pchk_"):
-            parts = call.data.split("_")
-            svc = parts[1]
-            fe_country = parts[2]
-            prov_country = parts[3]
-            res = call_hero_api('getPrices', service=svc, country=prov_country)
-            if isinstance(res, dict) and str(prov_country) in res:
-                sd = res[str(prov_country)].get(svc, {})
-                cost = sd.get('cost', 'N/A')
-                count = sd.get('count', 'N/A')
-                text = f"🏷️ {svc.upper()} @ {fe_country} (ID:{prov_country})\n💰 Cost: ${cost}\n📦 Stock: {count}"
-            else:
-                text = f"No data for {svc}@{prov_country}.\nRaw: {str(res)[:300]}"
-            markup = InlineKeyboardMarkup()
-            markup.add(InlineKeyboardButton("« Back to Countries", callback_data=f"price_svc_{svc}"))
-            markup.add(InlineKeyboardButton("« Main Menu", callback_data="main_menu"))
-            bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    @callback_router.route("view_prices")
+    def on_view_prices(call):
+        show(call, price_services_screen())
+
+    @callback_router.route("price_svc_", str)
+    def on_price_service(call, svc):
+        show(call, price_countries_screen(svc))
+
+    @callback_router.route("pchk_", str, str, str, slow=True)
+    def on_price_check(call, svc, fe_country, prov_country):
+        show(call, price_check_screen(svc, fe_country, prov_country))
 
     def process_set_quota(message, user_id):
         try:
             amount = int(message.text.strip())
-            conn = get_db_connection()
-            existing = conn.execute('SELECT user_id FROM quotas WHERE user_id = ?', (user_id,)).fetchone()
-            if existing:
-                conn.execute('UPDATE quotas SET allowed_numbers = ? WHERE user_id = ?', (amount, user_id))
-            else:
-                conn.execute('INSERT INTO quotas (user_id, allowed_numbers, used_numbers) VALUES (?, ?, 0)', (user_id, amount))
-            conn.commit()
-            conn.close()
+            with db() as conn:
+                existing = conn.execute('SELECT user_id FROM quotas WHERE user_id = ?', (user_id,)).fetchone()
+                if existing:
+                    conn.execute('UPDATE quotas SET allowed_numbers = ? WHERE user_id = ?', (amount, user_id))
+                else:
+                    conn.execute('INSERT INTO quotas (user_id, allowed_numbers, used_numbers) VALUES (?, ?, 0)', (user_id, amount))
             bot.reply_to(message, f"✅ Quota set to {amount} for user {user_id}")
         except ValueError:
             bot.reply_to(message, "❌ Enter a valid number.")
@@ -1159,17 +3166,15 @@ if TELEGRAM_BOT_TOKEN and ":" in TELEGRAM_BOT_TOKEN:
     def process_add_quota(message, user_id):
         try:
             amount = int(message.text.strip())
-            conn = get_db_connection()
-            existing = conn.execute('SELECT * FROM quotas WHERE user_id = ?', (user_id,)).fetchone()
-            if existing:
-                new_total = existing['allowed_numbers'] + amount
-                conn.execute('UPDATE quotas SET allowed_numbers = ? WHERE user_id = ?', (new_total, user_id))
-                msg = f"✅ Added {amount}. New total: {new_total}"
-            else:
-                conn.execute('INSERT INTO quotas (user_id, allowed_numbers, used_numbers) VALUES (?, ?, 0)', (user_id, amount))
-                msg = f"✅ Created quota: {amount}"
-            conn.commit()
-            conn.close()
+            with db() as conn:
+                existing = conn.execute('SELECT * FROM quotas WHERE user_id = ?', (user_id,)).fetchone()
+                if existing:
+                    new_total = existing['allowed_numbers'] + amount
+                    conn.execute('UPDATE quotas SET allowed_numbers = ? WHERE user_id = ?', (new_total, user_id))
+                    msg = f"✅ Added {amount}. New total: {new_total}"
+                else:
+                    conn.execute('INSERT INTO quotas (user_id, allowed_numbers, used_numbers) VALUES (?, ?, 0)', (user_id, amount))
+                    msg = f"✅ Created quota: {amount}"
             bot.reply_to(message, msg)
         except ValueError:
             bot.reply_to(message, "❌ Enter a valid number.")
@@ -1179,7 +3184,7 @@ if TELEGRAM_BOT_TOKEN and ":" in TELEGRAM_BOT_TOKEN:
             parts = message.text.split()
             if len(parts) == 2:
                 service, country = parts
-                res = call_hero_api('getPrices', service=service, country=country)
+                res = get_price_matrix()
 
                 if isinstance(res, dict) and str(country) in res:
                     service_data = res[str(country)].get(service, {})
@@ -1200,11 +3205,9 @@ if TELEGRAM_BOT_TOKEN and ":" in TELEGRAM_BOT_TOKEN:
             parts = message.text.split()
             if len(parts) == 2:
                 service, country = parts
-                conn = get_db_connection()
-                conn.execute('INSERT OR IGNORE INTO user_whitelist (user_id, service_id, country_id) VALUES (?, ?, ?)',
-                             (user_id, service, country))
-                conn.commit()
-                conn.close()
+                with db() as conn:
+                    conn.execute('INSERT OR IGNORE INTO user_whitelist (user_id, service_id, country_id) VALUES (?, ?, ?)',
+                                 (user_id, service, country))
                 bot.reply_to(message, f"✅ Added {service}@{country} to whitelist.")
             else:
                 bot.reply_to(message, "❌ Format: `service country` (e.g., `wa KE`)")
@@ -1213,58 +3216,90 @@ if TELEGRAM_BOT_TOKEN and ":" in TELEGRAM_BOT_TOKEN:
 
     def run_bot():
         print("Starting Telegram Bot...")
+        # getUpdates is refused while a webhook is registered
+        bot.remove_webhook()
         bot.infinity_polling()
 
-    bot_thread = threading.Thread(target=run_bot)
-    bot_thread.daemon = True
-    bot_thread.start()
+    if TELEGRAM_WEBHOOK_URL:
+        if BOT_LEADER:
+            try:
+                bot.set_webhook(url=f"{TELEGRAM_WEBHOOK_URL.rstrip('/')}/api/telegram/webhook",
+                                secret_token=TELEGRAM_WEBHOOK_SECRET,
+                                allowed_updates=['message', 'callback_query'])
+                print("Telegram webhook registered.")
+            except Exception as e:
+                print(f"Failed to register Telegram webhook: {e}")
+    elif BOT_LEADER:
+        bot_thread = threading.Thread(target=run_bot)
+        bot_thread.daemon = True
+        bot_thread.start()
+
+@app.route('/api/telegram/webhook', methods=['POST'])
+def telegram_webhook():
+    """Telegram pushes bot updates here when TELEGRAM_WEBHOOK_URL is set. Any worker process
+    can take them; they go through the same dispatcher and handlers as polled updates."""
+    if not (TELEGRAM_WEBHOOK_URL and TELEGRAM_BOT_TOKEN and ":" in TELEGRAM_BOT_TOKEN):
+        return jsonify({'message': 'Not found'}), 404
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(secret, TELEGRAM_WEBHOOK_SECRET):
+        return jsonify({'message': 'Forbidden'}), 403
+    try:
+        update = telebot.types.Update.de_json(request.get_data(as_text=True))
+    except Exception as e:
+        return jsonify({'message': f'Bad update: {e}'}), 400
+    bot.process_new_updates([update])
+    return jsonify({'ok': True})
 
 # --- Static Files & Single Page App Handling ---
 
+# (matrix, country map, json entry). Holding the matrix itself keeps the `is` check
+# honest: an id() could be reused by a later matrix once this one is freed.
+_price_summary = (None, None, None)
+
+def get_country_code_map():
+    """Provider country id -> our country code, from the mappings table."""
+    return {pid: fid for (mtype, fid), pid in get_mappings().items() if mtype == 'country'}
+
 @app.route('/api/prices', methods=['GET'])
 def get_prices():
     """Returns live prices from HeroSMS for all our mapped countries."""
+    global _price_summary
     if not HERO_SMS_API_KEY:
         return jsonify({'error': 'No API key configured'}), 503
 
-    res = call_hero_api('getPrices')
-    if not isinstance(res, dict):
-        return jsonify({'error': 'Failed to fetch prices', 'raw': str(res)}), 500
-
-    our_countries = {
-        'AE':'95','AU':'175','BR':'73','CA':'36','CH':'173','CN':'3',
-        'DE':'43','ES':'56','FR':'78','GB':'16','ID':'6','IN':'22',
-        'IT':'86','JP':'182','KE':'8','NG':'19','NL':'48','PH':'4',
-        'PL':'15','QA':'111','RU':'0','SA':'53','SE':'46','SG':'196',
-        'TR':'62','TZ':'9','UG':'75','US':'187','ZA':'31'
-    }
-    id_to_code = {v: k for k, v in our_countries.items()}
-
-    # Restructure: service -> country_code -> {cost, count}
-    summary = {}
-    for cid, services in res.items():
-        code = id_to_code.get(cid)
-        if not code:
-            continue
-        for svc, info in services.items():
-            if svc not in summary:
-                summary[svc] = {}
-            summary[svc][code] = {
-                'cost': info.get('cost'),
-                'count': info.get('count', 0)
-            }
-
-    return jsonify(summary)
-
-
+    try:
+        res = price_matrix_cache.get()
+    except ProviderError as e:
+        return jsonify({'error': 'Failed to fetch prices', 'raw': str(e)}), 500
+
+    id_to_code = get_country_code_map()
+    country_map = tuple(sorted(id_to_code.items()))
+    if _price_summary[0] is not res or _price_summary[1] != country_map:
+        # Restructure: service -> country_code -> {cost, count}
+        summary = {}
+        for cid, services in res.items():
+            code = id_to_code.get(cid)
+            if not code or not isinstance(services, dict):
+                continue
+            for svc, info in services.items():
+                if svc not in summary:
+                    summary[svc] = {}
+                summary[svc][code] = {
+                    'cost': info.get('cost'),
+                    'count': info.get('count', 0)
+                }
+        _price_summary = (res, country_map, _json_entry(summary))
+
+    response = cached_json_response(_price_summary[2])
+    response.headers['Age'] = str(int(price_matrix_cache.age() or 0))
+    return response
 
 
 @app.route('/api/pricing', methods=['GET'])
 def get_pricing():
     """Return our selling prices (KES + USD) for all service/country combos."""
-    conn = get_db_connection()
-    rows = conn.execute('SELECT * FROM pricing').fetchall()
-    conn.close()
+    with db() as conn:
+        rows = conn.execute('SELECT * FROM pricing').fetchall()
 
     result = {}
     for row in rows:
@@ -0,0 +1,91 @@
+"""Requests/s for DB-bound endpoints with the old connect-per-call helper vs. the pooled WAL connections.
+
+Runs in-process against Flask's test client in a scratch directory, with the provider replaced by
+a zero-latency fake_herosms instance, so no server or API key is needed.
+Usage: python verification/bench_db.py [threads] [requests_per_thread]
+"""
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix='smskenya-bench-'))
+
+from fake_herosms import FakeHeroSMS, start_fake_herosms
+
+_, fake_url, _ = start_fake_herosms(FakeHeroSMS(latency_ms=0))
+os.environ['BASE_API_URL'] = fake_url
+os.environ['HERO_SMS_API_KEY'] = 'bench'
+os.environ['TELEGRAM_BOT_TOKEN'] = ''
+# Only the request path: status reads go to the provider rather than a background poller
+for interval in ('STATUS_POLL_INTERVAL', 'PRICE_REFRESH_INTERVAL', 'STALE_SWEEP_INTERVAL'):
+    os.environ[interval] = '0'
+
+import jwt
+import server
+
+ORDERS_PER_USER = 200
+
+def legacy_connection():
+    # get_db_connection() as it was: a fresh connection per helper call, default pragmas
+    conn = sqlite3.connect(server.DB_PATH)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def seed(path):
+    server.DB_PATH = path
+    server.init_db()
+    conn = server.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO users (username, password_hash) VALUES ('bench', 'x')")
+    user_id = cursor.lastrowid
+    cursor.execute('INSERT INTO quotas (user_id, allowed_numbers, used_numbers) VALUES (?, 1000, 0)', (user_id,))
+    cursor.executemany(
+        "INSERT INTO orders (user_id, service_id, country_id, phone_number, order_id_provider, status) VALUES (?, 'wa', 'KE', '254700000000', ?, 'waiting')",
+        [(user_id, str(100000 + i)) for i in range(ORDERS_PER_USER)]
+    )
+    conn.commit()
+    conn.close()
+    return jwt.encode({'user_id': user_id, 'username': 'bench'}, server.SECRET_KEY)
+
+def run(label, threads, per_thread):
+    token = seed(f'bench_{label}.db')
+    headers = {'Authorization': f'Bearer {token}'}
+    client = server.app.test_client()
+    errors = []
+
+    def worker(n):
+        for i in range(per_thread):
+            # Mix of reads and the status endpoint, which writes
+            if i % 3 == 0:
+                r = client.get('/api/orders', headers=headers)
+            elif i % 3 == 1:
+                r = client.get('/api/me', headers=headers)
+            else:
+                r = client.get(f'/api/order/{100000 + (n * per_thread + i) % ORDERS_PER_USER}/status', headers=headers)
+            if r.status_code != 200:
+                errors.append(r.status_code)
+
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - start
+    total = threads * per_thread
+    print(f"{label:>7}: {total / elapsed:8.1f} req/s  ({total} requests, {threads} threads, {len(errors)} errors)")
+
+if __name__ == "__main__":
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    per_thread = int(sys.argv[2]) if len(sys.argv) > 2 else 150
+
+    pooled = server.get_db_connection
+    server.get_db_connection = legacy_connection
+    run('before', threads, per_thread)
+    server.get_db_connection = pooled
+    run('after', threads, per_thread)
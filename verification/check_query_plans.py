@@ -0,0 +1,86 @@
+"""Checks that every SQL statement in server.py that filters orders is served by an index.
+
+Pulls the SQL string literals straight out of server.py, runs EXPLAIN QUERY PLAN on each against
+a freshly migrated scratch database and fails on any full scan of a table listed in HOT_TABLES.
+Usage: python verification/check_query_plans.py
+"""
+import os
+import re
+import ast
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix='smskenya-plans-'))
+os.environ['HERO_SMS_API_KEY'] = ''
+os.environ['TELEGRAM_BOT_TOKEN'] = ''
+
+import server
+
+# Tables that grow with traffic. Small lookup tables (settings, mappings, pricing) may be scanned.
+HOT_TABLES = {'orders', 'purchase_tokens', 'tier_stats', 'quotas', 'user_whitelist', 'users'}
+SQL_START = re.compile(r'^\s*(SELECT|UPDATE|DELETE)\b', re.IGNORECASE)
+# "SCAN orders" or "SCAN o" for an alias; "SCAN orders USING INDEX ..." walks an index instead
+FULL_SCAN = re.compile(r'^SCAN (\w+)\b(?! USING\b)')
+# "FROM orders o", "JOIN quotas AS q": alias -> table
+TABLE_ALIAS = re.compile(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+NOT_ALIAS = {'WHERE', 'JOIN', 'LEFT', 'INNER', 'CROSS', 'ON', 'GROUP', 'ORDER', 'LIMIT', 'USING', 'SET', 'INDEXED', 'NOT'}
+
+# One-off data fixes run at startup, not per request
+SKIP_FUNCTIONS = {'init_db', 'migrate_db'}
+
+def sql_literals(path):
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    skip = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.FunctionDef) and node.name in SKIP_FUNCTIONS:
+            skip.update(id(n) for n in ast.walk(node))
+        elif isinstance(node, ast.JoinedStr):
+            skip.update(id(n) for n in node.values)
+    for node in ast.walk(tree):
+        if id(node) in skip:
+            continue
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            text = node.value
+        elif isinstance(node, ast.JoinedStr):
+            # f-strings only build placeholder lists here, e.g. IN ({",".join("?" * n)})
+            text = ''.join(v.value if isinstance(v, ast.Constant) else '?' for v in node.values)
+        else:
+            continue
+        if SQL_START.match(text) and ' WHERE ' in ' '.join(text.split()).upper():
+            yield node.lineno, ' '.join(text.split())
+
+def table_aliases(sql):
+    aliases = {}
+    for table, alias in TABLE_ALIAS.findall(sql):
+        aliases[table] = table
+        if alias and alias.upper() not in NOT_ALIAS:
+            aliases[alias] = table
+    return aliases
+
+def run():
+    conn = server.get_db_connection()
+    failures = 0
+    checked = 0
+    for lineno, sql in sql_literals(os.path.join(ROOT, 'server.py')):
+        try:
+            plan = conn.execute(f'EXPLAIN QUERY PLAN {sql}', (None,) * sql.count('?')).fetchall()
+        except Exception as e:
+            print(f"server.py:{lineno}: could not explain ({e}): {sql}")
+            failures += 1
+            continue
+        checked += 1
+        aliases = table_aliases(sql)
+        for row in plan:
+            m = FULL_SCAN.match(row['detail'])
+            if m and aliases.get(m.group(1), m.group(1)) in HOT_TABLES:
+                print(f"server.py:{lineno}: {row['detail']}\n    {sql}")
+                failures += 1
+    conn.close()
+    print(f"{checked} statements checked, {failures} problem(s)")
+    return failures == 0
+
+if __name__ == "__main__":
+    sys.exit(0 if run() else 1)
@@ -0,0 +1,235 @@
+"""Local stand-in for the HeroSMS handler API, for benchmarks and manual testing without spend.
+
+Implements the handler_api.php actions server.py uses, with the response shapes from
+api___en.json: getNumberV2 (price tiers, stock and balance), getStatusV2, getActiveActivations,
+cancelActivation (2 minute cancel lock, 20 minute refund window), getPrices and getBalance.
+Latency, injected 5xx errors and when (or whether) an SMS arrives are configurable.
+
+Run it and point the server at it:
+    python verification/fake_herosms.py --port 8900 --latency-ms 150 --error-rate 0.02
+    BASE_API_URL=http://127.0.0.1:8900/stubs/handler_api.php HERO_SMS_API_KEY=fake python server.py
+Benchmarks can start it in-process with start_fake_herosms().
+"""
+import sys
+import time
+import logging
+import random
+import argparse
+import threading
+from flask import Flask, request, jsonify
+from werkzeug.serving import make_server
+
+# Provider ids behind the default mappings in server.py
+SERVICES = ['wa', 'tg', 'ig', 'fb', 'go', 'lf', 'tw', 'ot', 'pp', 'am', 'ol']
+COUNTRIES = [str(c) for c in range(0, 200)]
+
+class FakeHeroSMS:
+    def __init__(self, api_key=None, latency_ms=50.0, error_rate=0.0, sms_rate=0.8, sms_mean_s=20.0,
+                 cancel_lock_s=120.0, refund_window_s=1200.0, balance=100.0, seed=0):
+        self.api_key = api_key
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.sms_rate = sms_rate
+        self.sms_mean_s = sms_mean_s
+        self.cancel_lock_s = cancel_lock_s
+        self.refund_window_s = refund_window_s
+        self.balance = balance
+        self.seed = seed
+
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self._offers = {}       # (service, country) -> [[price, count], ...] cheapest first
+        self._activations = {}  # activationId -> dict
+        self._next_id = 635468000
+        self.calls = {}
+
+    def offers(self, service, country):
+        """Numbers for sale per price tier; stable for a given seed."""
+        key = (service, country)
+        if key not in self._offers:
+            rng = random.Random(f"{self.seed}:{service}:{country}")
+            base = round(rng.choice([0.08, 0.25, 0.4, 0.9, 1.5, 2.5, 4.0]) * rng.uniform(0.8, 1.2), 2)
+            self._offers[key] = [[base, rng.choice([0, 5, 40, 300])],
+                                 [round(base * 2, 2), rng.choice([0, 20, 200])],
+                                 [round(base * 4, 2), rng.choice([10, 100, 1000])]]
+        return self._offers[key]
+
+    # --- actions ---
+
+    def get_balance(self, args):
+        return f"ACCESS_BALANCE:{self.balance:.2f}"
+
+    def get_prices(self, args):
+        services = [args['service']] if args.get('service') else SERVICES
+        countries = [args['country']] if args.get('country') else COUNTRIES
+        matrix = {}
+        for country in countries:
+            for service in services:
+                in_stock = [o for o in self.offers(service, country) if o[1] > 0]
+                count = sum(o[1] for o in in_stock)
+                matrix.setdefault(country, {})[service] = {
+                    'cost': in_stock[0][0] if in_stock else self.offers(service, country)[0][0],
+                    'count': count, 'physicalCount': count}
+        return matrix
+
+    def get_number_v2(self, args):
+        service, country = args.get('service'), args.get('country')
+        if not service or country is None:
+            return "BAD_SERVICE"
+        offers = self.offers(service, country)
+        max_price = float(args['maxPrice']) if args.get('maxPrice') else None
+        if max_price is not None and max_price < offers[0][0]:
+            return f"WRONG_MAX_PRICE:{offers[0][0]}"
+        offer = next((o for o in offers if o[1] > 0 and (max_price is None or o[0] <= max_price)), None)
+        if offer is None:
+            return "NO_NUMBERS"
+        if self.balance < offer[0]:
+            return "NO_BALANCE"
+        offer[1] -= 1
+        self.balance -= offer[0]
+        self._next_id += 1
+        now = time.time()
+        activation = {
+            'activationId': str(self._next_id), 'service': service, 'country': country,
+            'phoneNumber': f"2547{self._rng.randint(10000000, 99999999)}", 'cost': offer[0],
+            'created': now, 'status': 'waiting',
+            'sms_at': now + self._rng.expovariate(1 / self.sms_mean_s) if self._rng.random() < self.sms_rate else None,
+            'code': str(self._rng.randint(100000, 999999)),
+        }
+        self._activations[activation['activationId']] = activation
+        return {
+            'activationId': activation['activationId'], 'phoneNumber': activation['phoneNumber'],
+            'activationCost': offer[0], 'currency': 840, 'countryCode': country, 'canGetAnotherSms': True,
+            'activationTime': time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(now)),
+            'activationEndTime': time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(now + self.refund_window_s)),
+            'activationOperator': 'any',
+        }
+
+    def _refresh(self, activation, now):
+        if activation['status'] == 'waiting':
+            if activation['sms_at'] is not None and activation['sms_at'] <= now:
+                activation['status'] = 'received'
+            elif now - activation['created'] > self.refund_window_s:
+                activation['status'] = 'expired'
+        return activation
+
+    def get_status_v2(self, args):
+        activation = self._activations.get(str(args.get('id')))
+        if activation is None:
+            return "NO_ACTIVATION"
+        activation = self._refresh(activation, time.time())
+        if activation['status'] in ('cancelled', 'expired'):
+            return "STATUS_CANCEL"
+        sms = None
+        if activation['status'] == 'received':
+            sms = {'dateTime': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(activation['sms_at'])),
+                   'code': activation['code'], 'text': f"Your code is {activation['code']}"}
+        return {'verificationType': 0, 'sms': sms, 'call': None}
+
+    def get_active_activations(self, args):
+        now = time.time()
+        active = [self._refresh(a, now) for a in self._activations.values()]
+        active = [a for a in active if a['status'] in ('waiting', 'received')]
+        start, limit = int(args.get('start') or 0), int(args.get('limit') or 100)
+        page = active[start:start + limit]
+        if not page:
+            return {'status': 'error', 'error': 'NO_ACTIVATIONS'}
+        return {'status': 'success', 'activeActivations': [{
+            'activationId': a['activationId'], 'serviceCode': a['service'], 'phoneNumber': a['phoneNumber'],
+            'activationCost': a['cost'], 'activationStatus': '4' if a['status'] == 'waiting' else '2',
+            'smsCode': a['code'] if a['status'] == 'received' else None,
+            'smsText': f"Your code is {a['code']}" if a['status'] == 'received' else None,
+            'activationTime': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(a['created'])),
+            'countryCode': a['country'], 'canGetAnotherSms': '1', 'currency': 840,
+        } for a in page]}
+
+    def cancel_activation(self, args):
+        activation = self._activations.get(str(args.get('id')))
+        if activation is None:
+            return {'title': 'NOT_FOUND', 'details': 'Activation Not Found'}, 404
+        now = time.time()
+        activation = self._refresh(activation, now)
+        if activation['status'] in ('cancelled', 'expired'):
+            return {'title': 'CANCELED', 'details': 'Activation canceled.'}, 403
+        if activation['status'] == 'received':
+            return {'title': 'OTP_RECEIVED', 'details': 'Cannot terminate activation - OTP has been received on this number'}, 409
+        if now - activation['created'] < self.cancel_lock_s:
+            return {'title': 'EARLY_CANCEL_DENIED', 'details': "You can't cancel a number within the first 2 minutes"}, 409
+        activation['status'] = 'cancelled'
+        self.balance += activation['cost']
+        for offer in self.offers(activation['service'], activation['country']):
+            if offer[0] == activation['cost']:
+                offer[1] += 1
+        return '', 204
+
+    ACTIONS = {
+        'getBalance': get_balance,
+        'getPrices': get_prices,
+        'getNumberV2': get_number_v2,
+        'getStatusV2': get_status_v2,
+        'getActiveActivations': get_active_activations,
+        'cancelActivation': cancel_activation,
+    }
+
+    def handle(self, args):
+        """(body, status) for one handler_api.php request."""
+        if self.latency_ms:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency_ms / 1000)
+        action = args.get('action')
+        with self._lock:
+            self.calls[action] = self.calls.get(action, 0) + 1
+        if not args.get('api_key'):
+            return "NO_KEY", 200
+        if self.api_key and args['api_key'] != self.api_key:
+            return "BAD_KEY", 200
+        if random.random() < self.error_rate:
+            return {'title': 'SERVER_ERROR', 'details': 'Server Gone'}, 500
+        handler = self.ACTIONS.get(action)
+        if handler is None:
+            return "BAD_ACTION", 200
+        with self._lock:
+            result = handler(self, args)
+        return result if isinstance(result, tuple) else (result, 200)
+
+def create_app(fake):
+    app = Flask(__name__)
+
+    @app.route('/stubs/handler_api.php', methods=['GET', 'POST'])
+    def handler_api():
+        body, status = fake.handle(request.values.to_dict())
+        if isinstance(body, (dict, list)):
+            return jsonify(body), status
+        return body, status, {'Content-Type': 'text/plain'}
+
+    return app
+
+def start_fake_herosms(fake=None, port=0):
+    """Serve a FakeHeroSMS on a background thread. Returns (fake, base_url, server)."""
+    fake = fake or FakeHeroSMS()
+    # Keep the per-request access log out of benchmark output
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', port, create_app(fake), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return fake, f"http://127.0.0.1:{server.server_port}/stubs/handler_api.php", server
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--api-key', help='reject other keys with BAD_KEY (default: accept any)')
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='mean response delay (uniform +-50%%)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls answered with HTTP 500')
+    parser.add_argument('--sms-rate', type=float, default=0.8, help='fraction of activations that ever get an SMS')
+    parser.add_argument('--sms-mean', type=float, default=20.0, help='mean seconds until the SMS (exponential)')
+    parser.add_argument('--cancel-lock', type=float, default=120.0, help='seconds before cancelActivation is allowed')
+    parser.add_argument('--balance', type=float, default=100.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    fake = FakeHeroSMS(api_key=args.api_key, latency_ms=args.latency_ms, error_rate=args.error_rate,
+                       sms_rate=args.sms_rate, sms_mean_s=args.sms_mean, cancel_lock_s=args.cancel_lock,
+                       balance=args.balance, seed=args.seed)
+    print(f"Fake HeroSMS on http://127.0.0.1:{args.port}/stubs/handler_api.php")
+    make_server('127.0.0.1', args.port, create_app(fake), threaded=True).serve_forever()
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,82 @@
+"""Hammers /api/generate-number from many threads and checks the quota invariant.
+
+One user with QUOTA allowed numbers fires REQUESTS concurrent generates while the provider
+(get_number_with_smart_pricing, replaced in-process) sleeps a little and fails a share of the time.
+Afterwards used_numbers must equal the number of orders created and never exceed the quota.
+Usage: python verification/stress_quota.py [requests] [quota] [failure_rate]
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix='smskenya-quota-'))
+os.environ['HERO_SMS_API_KEY'] = ''
+os.environ['TELEGRAM_BOT_TOKEN'] = ''
+os.environ['STATUS_POLL_INTERVAL'] = '0'
+
+import jwt
+import server
+
+def flaky_provider(failure_rate):
+    counter = iter(range(10**9))
+    lock = threading.Lock()
+
+    def get_number(p_service, p_country):
+        time.sleep(random.uniform(0.001, 0.02))
+        if random.random() < failure_rate:
+            return {"error": "NO_NUMBERS", "details": "No numbers found"}
+        with lock:
+            n = next(counter)
+        return {"activationId": str(500000 + n), "phoneNumber": f"254700{n:06d}"}
+    return get_number
+
+def run():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    quota = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    failure_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.3
+
+    with server.db() as conn:
+        user_id = conn.execute("INSERT INTO users (username, password_hash) VALUES ('stress', 'x')").lastrowid
+        conn.execute('INSERT INTO quotas (user_id, allowed_numbers, used_numbers) VALUES (?, ?, 0)', (user_id, quota))
+    token = jwt.encode({'user_id': user_id, 'username': 'stress'}, server.SECRET_KEY)
+
+    # Exercise the real provider branch with a local stand-in for the escalator
+    server.HERO_SMS_API_KEY = 'stress'
+    server.get_number_with_smart_pricing = flaky_provider(failure_rate)
+
+    client = server.app.test_client()
+    results = []
+    start_gate = threading.Barrier(total)
+
+    def worker():
+        start_gate.wait()
+        r = client.post('/api/generate-number', json={'service_id': 'wa', 'country_id': 'KE'},
+                        headers={'Authorization': f'Bearer {token}'})
+        results.append(r.status_code)
+
+    threads = [threading.Thread(target=worker) for _ in range(total)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    with server.db() as conn:
+        used = conn.execute('SELECT used_numbers FROM quotas WHERE user_id = ?', (user_id,)).fetchone()['used_numbers']
+        orders = conn.execute('SELECT COUNT(*) FROM orders WHERE user_id = ?', (user_id,)).fetchone()[0]
+
+    counts = {code: results.count(code) for code in sorted(set(results))}
+    print(f"{total} requests in {elapsed:.2f}s, status codes: {counts}")
+    print(f"quota {quota}, used_numbers {used}, orders {orders}")
+    ok = used == orders and used <= quota and counts.get(200, 0) == orders
+    print("OK" if ok else "INVARIANT VIOLATED")
+    return ok
+
+if __name__ == "__main__":
+    sys.exit(0 if run() else 1)
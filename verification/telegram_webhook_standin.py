@@ -0,0 +1,48 @@
+"""Stand-in for Telegram's webhook pushes: POSTs recorded bot updates to a running server.
+
+The server must run with TELEGRAM_WEBHOOK_URL set (any value works locally, nothing needs to
+reach Telegram for the route to accept updates). Replies the handlers send still go to the real
+Bot API, so use a test bot token and your own chat id as ADMIN_TELEGRAM_ID.
+Usage: TELEGRAM_BOT_TOKEN=... ADMIN_TELEGRAM_ID=... python verification/telegram_webhook_standin.py [base_url] [fixture ...]
+"""
+import os
+import sys
+import time
+import hashlib
+import requests
+
+def fixtures(admin_id):
+    sender = {"id": int(admin_id), "is_bot": False, "first_name": "Admin"}
+    chat = {"id": int(admin_id), "type": "private"}
+    now = int(time.time())
+    return {
+        # Recorded /menu command
+        "menu": {"update_id": 1, "message": {
+            "message_id": 101, "date": now, "chat": chat, "from": sender, "text": "/menu",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 5}]}},
+        # Recorded tap on "Manage Users" under the menu message
+        "list_users": {"update_id": 2, "callback_query": {
+            "id": "4382bfdwdsb323b2d9", "chat_instance": "-1", "data": "list_users", "from": sender,
+            "message": {"message_id": 102, "date": now, "chat": chat, "text": "SMSKenya Admin Panel:"}}},
+        # Slow callback: acked immediately, answered by message
+        "balance": {"update_id": 3, "callback_query": {
+            "id": "4382bfdwdsb323b2da", "chat_instance": "-1", "data": "check_balance", "from": sender,
+            "message": {"message_id": 102, "date": now, "chat": chat, "text": "SMSKenya Admin Panel:"}}},
+    }
+
+def run():
+    base_url = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:8000"
+    token = os.environ.get('TELEGRAM_BOT_TOKEN', '')
+    # Same default the server derives when TELEGRAM_WEBHOOK_SECRET is unset
+    secret = os.environ.get('TELEGRAM_WEBHOOK_SECRET') or hashlib.sha256(
+        f"telegram-webhook:{token}".encode()).hexdigest()[:32]
+    recorded = fixtures(os.environ.get('ADMIN_TELEGRAM_ID', '0'))
+    names = sys.argv[2:] or list(recorded)
+
+    for name in names:
+        res = requests.post(f"{base_url}/api/telegram/webhook", json=recorded[name],
+                            headers={'X-Telegram-Bot-Api-Secret-Token': secret}, timeout=5)
+        print(f"{name}: {res.status_code} {res.text.strip()}")
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,39 @@
+"""Stand-in for HeroSMS webhook pushes: POSTs fixture sms-incoming payloads to a running server.
+
+Usage: PROVIDER_WEBHOOK_SECRET=... python verification/webhook_standin.py [base_url] [activation_id ...]
+"""
+import os
+import sys
+import datetime
+import requests
+
+FIXTURES = [
+    # Matches the sms-incoming schema in api___en.json
+    {"service": "wa", "text": "Your WhatsApp code is 123-456", "code": "123456", "country": 8},
+    # Some services only give text; the server falls back to it
+    {"service": "tg", "text": "Telegram code 55821", "country": 187},
+]
+
+def push(base_url, secret, activation_id, fixture):
+    payload = dict(fixture, activationId=activation_id,
+                   receivedAt=datetime.datetime.now(datetime.UTC).isoformat())
+    return requests.post(f"{base_url}/api/provider/webhook", params={'secret': secret}, json=payload, timeout=3)
+
+def run():
+    base_url = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:8000"
+    activation_ids = sys.argv[2:] or ["635468024"]
+    secret = os.environ.get('PROVIDER_WEBHOOK_SECRET', '')
+
+    for i, activation_id in enumerate(activation_ids):
+        fixture = FIXTURES[i % len(FIXTURES)]
+        res = push(base_url, secret, activation_id, fixture)
+        print(f"{activation_id}: {res.status_code} {res.text.strip()}")
+        # The provider retries; a second identical push must be a no-op
+        res = push(base_url, secret, activation_id, fixture)
+        print(f"{activation_id} (retry): {res.status_code} {res.text.strip()}")
+
+    res = requests.post(f"{base_url}/api/provider/webhook", params={'secret': 'wrong'}, json=FIXTURES[0], timeout=3)
+    print(f"bad secret: {res.status_code}")
+
+if __name__ == "__main__":
+    run()